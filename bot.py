@@ -1,4 +1,9 @@
+import challenge_state
 import cogs
+import io
+import karma
+import karma_graph
+import refill
 import os
 import traceback
 import random
@@ -6,65 +11,81 @@ import asyncio
 import aiosqlite
 import sqlite3
 import json
-import matplotlib.pyplot as plt
-import seaborn as sns
 
 from discord import File
 from discord.ext import commands
 from datetime import datetime, timedelta
-from cogs import BotErr, GuildAmbiguity
-from db import Db, Guild, Challenge, Pool, User, Participant, Title, Roll, KarmaHistory, UserStats
-from export import export
-from thirdparty_api.api_title_info import ApiTitleInfo
-from utils import gen_fname
-from time import sleep
+from cogs import BotErr, GuildAmbiguity, SyncErr
+from db import DEFAULT_PRAGMAS, STATEMENT_CACHE_SIZE, Db, Session, Guild, Challenge, Pool, User, Participant, Title, Roll, KarmaHistory, UserStats
+from export import export, export_all, configure as configure_export
+from html_profile.image_cache import ProfileImageCache
+from html_profile.renderer import ProfileRenderer
+from migrate import migrate
+from sync_scheduler import SyncScheduler
+from thirdparty_api.http_client import close_all as close_http_clients
+from thirdparty_api.title_info_cache import TitleInfoCache
+
+PROFILE_CSS_PATH = './html_profile/styles.css'
 
 class State:
     @staticmethod
     async def fetch(bot, ctx, allow_started=False, guild_id = None):
-        guild = await bot.fetch_guild_from_ctx(ctx, guild_id)
-        cc = await guild.fetch_current_challenge()
+        if ctx.message.guild:
+            discord_id = ctx.message.guild.id
+        else:
+            discord_id = (await bot.fetch_guild_from_ctx(ctx, guild_id)).discord_id
+        cached = await challenge_state.fetch(ctx.db, discord_id)
+        guild = cached.load_guild(ctx.db)
+        cc = cached.load_challenge(ctx.db)
         BotErr.raise_if(cc is None, 'Create a new challenge first.')
-        BotErr.raise_if(cc is not None and not allow_started and await cc.has_started(),
+        BotErr.raise_if(not allow_started and cached.has_started,
             'Cannot add/delete user/title/pool after a challenge has started.')
-        return State(bot, guild, cc)
+        return State(bot, ctx.db, guild, cc, cached)
 
-    def __init__(self, bot, guild, cc):
+    def __init__(self, bot, db, guild, cc, cached):
         self.bot = bot
+        self.db = db
         self.guild = guild
         self.cc = cc
+        self.cached = cached
 
     async def fetch_user(self, user):
-        return await User.fetch_or_insert(self.bot.db, user.id, user.name)
+        u = self.cached.load_user(self.db, user.id)
+        return u if u is not None else await User.fetch_or_insert(self.db, user.id, user.name)
 
     async def fetch_participant(self, user):
         u = await self.fetch_user(user)
-        p = await self.cc.fetch_participant(u.id)
+        p = self.cached.load_participant(self.db, u.id)
         BotErr.raise_if(p is None, f'User {user.mention} is not participating in this challenge.')
         BotErr.raise_if(p.has_failed(), f'User {user.mention} has failed this challenge.')
         return p
 
     async def has_participant(self, user):
         u = await self.fetch_user(user)
-        return await self.cc.has_participant(u.id)
+        return u.id in self.cached.participants
 
     async def fetch_pool(self, name):
-        p = await self.cc.fetch_pool(name)
+        p = self.cached.load_pool(self.db, name)
         BotErr.raise_if(p is None, f'Pool "{name}" does not exist.')
         return p
 
     async def fetch_title(self, name):
-        t = await self.cc.fetch_title(name)
-        BotErr.raise_if(t is None, f'Title "{name}" does not exist.')
-        return t
+        matches = await self.cc.search_titles(name)
+        BotErr.raise_if(len(matches) == 0, f'Title "{name}" does not exist.')
+        best = [t.name for t, score in matches if score == matches[0][1]]
+        BotErr.raise_if(len(best) > 1, f'Title "{name}" is ambiguous: ' + ', '.join(f'"{n}"' for n in best) + '.')
+        return matches[0][0]
 
     async def fetch_titles(self):
         t = await self.cc.fetch_titles()
         # BotErr.raise_if(t is None, f'fetch_titles')
         return t
 
+    async def fetch_users_participants(self):
+        return self.cached.load_users_participants(self.db)
+
     async def fetch_last_round(self, allow_past_deadline=False):
-        lr = await self.cc.fetch_last_round()
+        lr = self.cached.load_last_round(self.db)
         BotErr.raise_if(lr is None, 'Create a new round first.')
         BotErr.raise_if(lr is not None and (lr.is_finished
             or not allow_past_deadline and datetime.now() > lr.finish_time), 'Round has ended.')
@@ -74,7 +95,7 @@ class State:
         return await self.cc.fetch_banned_users()
 
     async def is_user_banned(self, user):
-        return user.id in [ x.id for x in await self.fetch_banned_users() ]
+        return user.id in self.cached.banned_user_ids
 
 class Bot(commands.Bot):
     def __init__(self, db, config):
@@ -84,11 +105,37 @@ class Bot(commands.Bot):
         self.add_cog(cogs.User(self))
         self.db = db
         self.config = config
+        configure_export(config)
+        self.title_info_cache = TitleInfoCache(config)
+        self.sync_scheduler = SyncScheduler(self._sync_challenge, self._report_sync_error,
+            config.get('sync_quiet_period', 5), config.get('sync_max_delay', 30))
+        profile_cache = ProfileImageCache(PROFILE_CSS_PATH, config.get('profile_cache_size', 32),
+            config.get('profile_cache_dir'), config.get('profile_cache_disk_size', 1000))
+        self.profile_renderer = ProfileRenderer(PROFILE_CSS_PATH,
+            config.get('profile_render_workers', 2), config.get('profile_render_queue', 8), profile_cache)
+
+    async def close(self):
+        await self.sync_scheduler.flush_all()
+        await close_http_clients()
+        await self.profile_renderer.close()
+        karma_graph.executor.shutdown(wait=False)
+        await super().close()
+
+    async def invoke(self, ctx):
+        ctx.db = Session(self.db)
+        await super().invoke(ctx)
+        # discord.py reports a failed command through on_command_error and sets command_failed
+        if ctx.command_failed:
+            ctx.db.discard()
+        else:
+            await ctx.db.flush()
 
     async def on_command_error(self, ctx, e):
         cmd = self.get_command(ctx.message.content.lstrip()[1:])
         help = '' if cmd is None else cmd.help
-        if isinstance(e, commands.CommandInvokeError):
+        if isinstance(e, SyncErr):
+            await ctx.send(str(e))
+        elif isinstance(e, commands.CommandInvokeError):
             if isinstance(e.original, BotErr):
                 await ctx.send(f'{e.original}\nUsage:\n{help}')
             else:
@@ -98,8 +145,8 @@ class Bot(commands.Bot):
         else:
             await ctx.send(f'{e}\nUsage:\n{help}')
 
-    def get_api_title_info(self, url):
-        return ApiTitleInfo.from_url(url, self.config)
+    async def get_api_title_info(self, ctx, url):
+        return await self.title_info_cache.fetch(ctx.db, url)
 
     async def has_pool(self, ctx, pool_name, guild_id = None):
         state = await State.fetch(self, ctx, guild_id = guild_id, allow_started=True)
@@ -110,7 +157,7 @@ class Bot(commands.Bot):
         return await state.fetch_titles()
 
     async def start_challenge(self, ctx, name):
-        guild = await Guild.fetch_or_insert(self.db, ctx.message.guild.id)
+        guild = await Guild.fetch_or_insert(ctx.db, ctx.message.guild.id)
         if guild.current_challenge_id is not None:
             raise BotErr(f'Finish "{(await guild.fetch_current_challenge()).name}" challenge first.')
         BotErr.raise_if(await guild.has_challenge(name), f'Challenge "{name}" already exists.')
@@ -118,44 +165,51 @@ class Bot(commands.Bot):
         await challenge.add_pool('main')
         guild.current_challenge_id = challenge.id
         await guild.update()
-        await self.db.commit()
+        await ctx.db.commit()
+        challenge_state.invalidate(guild.discord_id)
 
     async def set_allow_hidden(self, ctx, val):
         state = await State.fetch(self, ctx, allow_started=True)
         state.cc.allow_hidden = val
         await state.cc.update()
-        await self.db.commit()
+        await ctx.db.commit()
+        challenge_state.on_challenge(state.guild.discord_id, state.cc)
 
     async def end_challenge(self, ctx):
         state = await State.fetch(self, ctx, allow_started=True)
-        lr = await state.cc.fetch_last_round()
+        lr = state.cached.load_last_round(ctx.db)
         if lr is not None and not lr.is_finished:
             await self._end_round(lr)
         state.cc.finish_time = datetime.now()
         await state.cc.update()
         state.guild.current_challenge_id = None
         await state.guild.update()
-        await self.db.commit()
+        await ctx.db.commit()
+        challenge_state.invalidate(state.guild.discord_id)
         return state.cc
 
     async def add_pool(self, ctx, name):
         state = await State.fetch(self, ctx)
-        BotErr.raise_if(await state.cc.has_pool(name), f'Pool "{name}" already exists.')
-        await state.cc.add_pool(name)
-        await self.db.commit()
+        BotErr.raise_if(state.cached.load_pool(ctx.db, name) is not None, f'Pool "{name}" already exists.')
+        pool = await state.cc.add_pool(name)
+        await ctx.db.commit()
+        challenge_state.on_pool(state.guild.discord_id, pool)
 
     async def remove_pool(self, ctx, name):
         state = await State.fetch(self, ctx)
-        await (await state.fetch_pool(name)).delete()
-        await self.db.commit()
+        pool = await state.fetch_pool(name)
+        await pool.delete()
+        await ctx.db.commit()
+        challenge_state.on_remove_pool(state.guild.discord_id, pool)
 
     async def rename_pool(self, ctx, old_name, new_name):
         state = await State.fetch(self, ctx, allow_started=True)
-        BotErr.raise_if(await state.cc.has_pool(new_name), f'Pool "{new_name}" already exists.')
+        BotErr.raise_if(state.cached.load_pool(ctx.db, new_name) is not None, f'Pool "{new_name}" already exists.')
         pool = await state.fetch_pool(old_name)
         pool.name = new_name
         await pool.update()
-        await self.db.commit()
+        await ctx.db.commit()
+        challenge_state.on_pool(state.guild.discord_id, pool)
 
     async def add_user(self, ctx, user):
         state = await State.fetch(self, ctx)
@@ -163,24 +217,28 @@ class Bot(commands.Bot):
 
         BotErr.raise_if(await state.is_user_banned(u),
             f'User {user.mention} is banned in this challenge')
-        BotErr.raise_if(await state.cc.has_started(),
+        BotErr.raise_if(state.cached.has_started,
             f'The challenge has already started.')
         BotErr.raise_if(await state.has_participant(user),
             f'User {user.mention} is already participating in this challenge.')
 
-        await state.cc.add_participant(u.id)
-        await self.db.commit()
+        participant = await state.cc.add_participant(u.id)
+        await ctx.db.commit()
+        challenge_state.on_add_participant(state.guild.discord_id, u, participant)
 
     async def remove_user(self, ctx, user):
         state = await State.fetch(self, ctx, allow_started=True)
         participant = await state.fetch_participant(user)
-        last_round = await state.cc.fetch_last_round()
+        last_round = state.cached.load_last_round(ctx.db)
         if last_round is not None:
             participant.failed_round_id = last_round.id
             await participant.update()
+            await ctx.db.commit()
+            challenge_state.on_participants(state.guild.discord_id, [participant])
         else:
             await participant.delete()
-        await self.db.commit()
+            await ctx.db.commit()
+            challenge_state.on_remove_participant(state.guild.discord_id, participant)
 
     async def ban_user(self, ctx, user):
         state = await State.fetch(self, ctx, allow_started=True)
@@ -188,7 +246,8 @@ class Bot(commands.Bot):
         BotErr.raise_if(await state.is_user_banned(u),
             f'User {user.mention} has already been banned')
         await state.cc.add_banned_user(u)
-        await self.db.commit()
+        await ctx.db.commit()
+        challenge_state.on_ban(state.guild.discord_id, u.id, True)
 
     async def unban_user(self, ctx, user):
         state = await State.fetch(self, ctx, allow_started=True)
@@ -196,7 +255,8 @@ class Bot(commands.Bot):
         BotErr.raise_if(not await state.is_user_banned(u),
             f'User {user.mention} is not banned')
         await state.cc.remove_banned_user(u)
-        await self.db.commit()
+        await ctx.db.commit()
+        challenge_state.on_ban(state.guild.discord_id, u.id, False)
 
     async def add_title(self, ctx, params, is_admin=False):
         # ? maybe move it into a class
@@ -220,15 +280,15 @@ class Bot(commands.Bot):
         participant = await state.fetch_participant(user)
         pool = await state.fetch_pool(pool)
         await pool.add_title(participant.id, name, url, score, num_of_episodes, duration, difficulty, is_hidden)
-        await self.db.commit()
+        await ctx.db.commit()
 
     async def fetch_guild_from_ctx(self, ctx, guild_id):
         guild = ctx.message.guild
         if guild:
-            guild = await Guild.fetch_or_insert(self.db, guild.id)
+            guild = await Guild.fetch_or_insert(ctx.db, guild.id)
         else: # we're in dms, so we try to deduce the guild from db
             author = ctx.message.author
-            user = await User.fetch_or_insert(self.db, author.id, author.name)
+            user = await User.fetch_or_insert(ctx.db, author.id, author.name)
             active_guilds = await user.fetch_active_guilds()
 
             if guild_id == None and len(active_guilds) > 1:
@@ -248,19 +308,18 @@ class Bot(commands.Bot):
         BotErr.raise_if(participant.id != title.participant_id and not is_admin, "Can't remove other's title") 
         BotErr.raise_if(title.is_used, "Cannot delete title that's already been used.")
         await title.delete()
-        await self.db.commit()
+        await ctx.db.commit()
 
     async def rename_title(self, ctx, old_name, new_name):
         state = await State.fetch(self, ctx)
         BotErr.raise_if(await state.cc.has_title(new_name), f'Title "{new_name}" already exists.')
         title = await state.fetch_title(old_name)
-        title.name = new_name
-        await title.update()
-        await self.db.commit()
+        await title.rename(new_name)
+        await ctx.db.commit()
 
     async def start_round(self, ctx, days, pool):
         state = await State.fetch(self, ctx, allow_started=True)
-        last_round = await state.cc.fetch_last_round()
+        last_round = state.cached.load_last_round(ctx.db)
         if last_round is not None and not last_round.is_finished:
             raise BotErr(f'Finish round {last_round.num} first.')
 
@@ -269,24 +328,22 @@ class Bot(commands.Bot):
         users = { up[0].id: up[0] for up in users_participants }
         participants = [ up[1] for up in filter(lambda up: not up[1].has_failed(), users_participants) ]
         BotErr.raise_if(len(participants) == 0, 'Not enough participants to start a round.')
-        titles = await pool.fetch_unused_titles()
+        titles = await pool.fetch_random_unused_titles(len(participants))
         BotErr.raise_if(len(titles) < len(participants), f'Not enough titles in "{pool}" pool.')
 
         num = last_round.num + 1 if last_round is not None else 0
         start = datetime.now()
         new_round = await state.cc.add_round(num, start, start + timedelta(days=days))
 
-        rand_titles = [ titles.pop(random.randrange(len(titles))) for _ in range(len(participants)) ]
-        for participant, title in zip(participants, rand_titles):
-            await new_round.add_roll(participant.id, title.id)
-            participant.progress_current = None
-            participant.progress_total = None
-            title.is_used = True
-            await participant.update()
-            await title.update()
+        # Titles come back in random order, so the n-th participant gets the n-th title
+        await new_round.add_rolls([ (p.id, t.id) for p, t in zip(participants, titles) ])
+        await Participant.reset_progress(ctx.db, participants)
+        await Title.mark_used(ctx.db, titles)
 
-        await self.db.commit()
-        return new_round, { users[p.user_id].name: t.name for p, t in zip(participants, rand_titles) }
+        await ctx.db.commit()
+        challenge_state.on_round(state.guild.discord_id, new_round)
+        challenge_state.on_participants(state.guild.discord_id, participants)
+        return new_round, { users[p.user_id].name: t.name for p, t in zip(participants, titles) }
 
     async def round_info(self, ctx):
         state = await State.fetch(self, ctx, allow_started=True)
@@ -298,77 +355,37 @@ class Bot(commands.Bot):
         await ctx.send(f"Round {lr.num} finishes on {lr.finish_time}")
 
     async def refill_title_info(self, ctx):
-        guild = await Guild.fetch_or_insert(self.db, ctx.message.guild.id)
-
-        challenges = await guild.fetch_challenges()
-        for c in challenges:
-            titles = await c.fetch_titles()
-            for title in titles:
-                for i in range(5):
-                    try:
-                        sleep(0.2)
-                        print(title.name)
-                        title_info = self.get_api_title_info(title.url)
-                        title.score = title_info.score
-                        title.duration = title_info.duration
-                        title.num_of_episodes = title_info.num_of_episodes
-                        title.difficulty = title_info.difficulty
-                        await title.update()
-                        break
-                    except:
-                        print(f"Failed: {i}")
-                        pass
-        await self.db.commit()
+        guild = await Guild.fetch_or_insert(ctx.db, ctx.message.guild.id)
+        message = await ctx.send('Refilling title info...')
+
+        async def report(done, total, failed):
+            await message.edit(content=f'Refilling title info: {done}/{total} done, {len(failed)} failed.')
+
+        failed, skipped = await refill.refill_guild(ctx.db, guild, self.title_info_cache, report)
+        if skipped:
+            await ctx.send(f'Skipped {skipped} titles without an url.')
+        if failed:
+            names = '\n'.join(f'{t.name} ({t.url})' for t in failed[:refill.MAX_FAILURES_SHOWN])
+            more = len(failed) - refill.MAX_FAILURES_SHOWN
+            if more > 0:
+                names += f'\n...and {more} more'
+            await ctx.send(f'Failed to refill {len(failed)} titles:\n{names}')
 
     async def calc_karma(self, round):
         if not round.is_finished:
             return
-        rolls = await round.fetch_rolls()
-        time = round.finish_time
-
-        for roll in rolls:
-            proposer = await roll.fetch_title_author()
-            watcher = await roll.fetch_user()
-            score = roll.score
-            participant = await roll.fetch_participant()
-
-            if participant.failed_round_id == round.id:
-                watcher_karma = await KarmaHistory.fetch_user_karma(self.db, watcher.id)
-                watcher_karma -= 25    
-                await KarmaHistory.insert_or_update_karma(self.db, watcher.id, watcher_karma, time)
-
-            if score != None:
-                watcher_karma = await KarmaHistory.fetch_user_karma(self.db, watcher.id)
-                title = await roll.fetch_title()
-                watcher_karma += title.difficulty // 10
-                await KarmaHistory.insert_or_update_karma(self.db, watcher.id, watcher_karma, time)
-
-                if 1:#watcher.id != proposer.id:
-                    proposer_karma = await KarmaHistory.fetch_user_karma(self.db, proposer.id)
-                    # proposer_karma += (score-6.5) * (title.difficulty / 10)
-                    proposer_karma -= title.difficulty // 20
-                    await KarmaHistory.insert_or_update_karma(self.db, proposer.id, proposer_karma, time)
-    
-    async def recalc_karma(self, ctx):
-        guild = await Guild.fetch_or_insert(self.db, ctx.message.guild.id)
-        users = await guild.fetch_users()
-        for u in users:
-            await KarmaHistory.clear_user_karma_history(self.db, u.id)
-
-        challenges = await guild.fetch_challenges()
-
-        for c in challenges:
-            print(c.name)
-            rounds = await c.fetch_rounds()
-            for r in rounds:
-                await self.calc_karma(r)
+        await karma.calc_round_karma(round.db, round)
 
-        await self.db.commit()
+    async def recalc_karma(self, ctx):
+        guild = await Guild.fetch_or_insert(ctx.db, ctx.message.guild.id)
+        await karma.recalc_guild_karma(ctx.db, guild)
+        await ctx.db.commit()
+        karma_graph.clear_cache()
 
     async def _end_round(self, last_round):
         rwp = await last_round.fetch_rolls_watchers_proposers()
         failed_participants = map(lambda x: x[0].participant_id, filter(lambda x: x[0].score is None, rwp))
-        await Participant.fail_participants(self.db, last_round.id, failed_participants)
+        await Participant.fail_participants(last_round.db, last_round.id, failed_participants)
         last_round.is_finished = True
         await last_round.update()
 
@@ -378,7 +395,8 @@ class Bot(commands.Bot):
         state = await State.fetch(self, ctx, allow_started=True)
         last_round = await state.fetch_last_round(allow_past_deadline=True)
         await self._end_round(last_round)
-        await self.db.commit()
+        await ctx.db.commit()
+        challenge_state.invalidate(state.guild.discord_id)
         return last_round
 
     async def extend_round(self, ctx, days):
@@ -386,7 +404,8 @@ class Bot(commands.Bot):
         last_round = await state.fetch_last_round(allow_past_deadline=True)
         last_round.finish_time += timedelta(days=days)
         await last_round.update()
-        await self.db.commit()
+        await ctx.db.commit()
+        challenge_state.on_round(state.guild.discord_id, last_round)
         return last_round
 
     async def rate(self, ctx, user, score):
@@ -396,7 +415,7 @@ class Bot(commands.Bot):
         roll = await last_round.fetch_roll(participant.id)
         roll.score = score
         await roll.update()
-        await self.db.commit()
+        await ctx.db.commit()
         return await roll.fetch_title()
 
     async def swap(self, ctx, user1, user2):
@@ -414,7 +433,7 @@ class Bot(commands.Bot):
         roll1.title_id, roll2.title_id = roll2.title_id, roll1.title_id
         await roll1.update()
         await roll2.update()
-        await self.db.commit()
+        await ctx.db.commit()
         return await roll2.fetch_title(), await roll1.fetch_title()
 
     async def _set_title(self, roll, new_title):
@@ -437,7 +456,7 @@ class Bot(commands.Bot):
         BotErr.raise_if(len(titles) == 0, f'Not enough titles in "{pool}" pool.')
         new_title = random.choice(titles)
         await self._set_title(roll, new_title)
-        await self.db.commit()
+        await ctx.db.commit()
         return new_title
 
     async def set_title(self, ctx, user, title):
@@ -447,17 +466,16 @@ class Bot(commands.Bot):
         roll = await last_round.fetch_roll(participant.id)
         new_title = await state.fetch_title(title)
         await self._set_title(roll, new_title)
-        await self.db.commit()
+        await ctx.db.commit()
 
     async def karma_table(self, ctx):
-        guild = await Guild.fetch_or_insert(self.db, ctx.message.guild.id)
-        users = [ (user, await KarmaHistory.fetch_user_karma(self.db, user.id)) for user in await guild.fetch_users() ]
-        users = sorted(users, key=lambda x: x[1], reverse=True)
+        guild = await Guild.fetch_or_insert(ctx.db, ctx.message.guild.id)
+        users = await guild.fetch_users_karma()
         return [(u[0].name, '{:.1f}'.format(u[1])) for u in users]
 
     async def difficulty_table(self, ctx, challenge_name=None, user=None):
         state = await State.fetch(self, ctx, allow_started=True)
-        guild = await Guild.fetch_or_insert(self.db, ctx.message.guild.id)
+        guild = await Guild.fetch_or_insert(ctx.db, ctx.message.guild.id)
         titles = []
         if challenge_name:
             challenge = await guild.fetch_challenge(challenge_name)
@@ -475,21 +493,23 @@ class Bot(commands.Bot):
         return [(t.name, f'{t.difficulty}') for t in titles]
 
     async def user_profile(self, ctx, user):
-        guild = await Guild.fetch_or_insert(self.db, ctx.message.guild.id)
-        user = await User.fetch_or_insert(self.db, user.id, user.name)
-        return user, await UserStats.fetch(self.db, user.id, guild.id)
+        guild = await Guild.fetch_or_insert(ctx.db, ctx.message.guild.id)
+        user = await User.fetch_or_insert(ctx.db, user.id, user.name)
+        return user, await UserStats.fetch(ctx.db, user.id, guild.id)
 
-    async def set_name(self, user, name):
-        u = await User.fetch_or_insert(self.db, user.id, user.name)
+    async def set_name(self, ctx, user, name):
+        u = await User.fetch_or_insert(ctx.db, user.id, user.name)
         u.name = name
         await u.update()
-        await self.db.commit()
+        await ctx.db.commit()
+        challenge_state.on_user(u)
 
-    async def set_color(self, user, color):
-        u = await User.fetch_or_insert(self.db, user.id, user.name)
+    async def set_color(self, ctx, user, color):
+        u = await User.fetch_or_insert(ctx.db, user.id, user.name)
         u.color = color
         await u.update()
-        await self.db.commit()
+        await ctx.db.commit()
+        challenge_state.on_user(u)
 
     async def set_progress(self, ctx, user, prog_current, prog_total=None):
         state = await State.fetch(self, ctx, allow_started=True)
@@ -497,43 +517,68 @@ class Bot(commands.Bot):
         participant.progress_current = prog_current
         participant.progress_total = prog_total
         await participant.update()
-        await self.db.commit()
+        await ctx.db.commit()
+        challenge_state.on_participants(state.guild.discord_id, [participant])
 
     async def add_progress(self, ctx, user, num):
         state = await State.fetch(self, ctx, allow_started=True)
         participant = await state.fetch_participant(user)
         participant.progress_current += num      
         await participant.update()
-        await self.db.commit()    
+        await ctx.db.commit()    
+        challenge_state.on_participants(state.guild.discord_id, [participant])
 
     async def progress_table(self, ctx):
         state = await State.fetch(self, ctx, allow_started=True)
-        users_participants = sorted(await state.cc.fetch_users_participants(), key=lambda up: up[0].name)
+        users_participants = sorted(await state.fetch_users_participants(), key=lambda up: up[0].name)
         return [(up[0].name, up[1].progress_current, up[1].progress_total) for up in users_participants]
 
     async def set_spreadsheet_key(self, ctx, key):
-        guild = await Guild.fetch_or_insert(self.db, ctx.message.guild.id)
+        guild = await Guild.fetch_or_insert(ctx.db, ctx.message.guild.id)
         guild.spreadsheet_key = key
         await guild.update()
-        await self.db.commit()
+        await ctx.db.commit()
+        challenge_state.on_guild(guild)
 
     async def sync(self, ctx, guild_id=None):
         state = await State.fetch(self, ctx, allow_started=True, guild_id=guild_id)
         BotErr.raise_if(state.guild.spreadsheet_key is None, 'Spreadsheet key is not set.')
-        await export(state.guild.spreadsheet_key, state.cc)
+        self.sync_scheduler.mark_dirty(state.cc.id, ctx)
+
+    async def flush_sync(self, ctx):
+        state = await State.fetch(self, ctx, allow_started=True)
+        BotErr.raise_if(state.guild.spreadsheet_key is None, 'Spreadsheet key is not set.')
+        await self.sync_scheduler.flush(state.cc.id)
+
+    async def _sync_challenge(self, challenge_id):
+        challenge = await Challenge.fetch_current_challenge(self.db, challenge_id)
+        guild = await Guild.fetch(self.db, challenge.guild_id)
+        if guild.spreadsheet_key is None:
+            return
+        try:
+            await export(guild.spreadsheet_key, challenge)
+        except Exception as e:
+            raise SyncErr(e)
+
+    async def _report_sync_error(self, ctx, e):
+        await ctx.send(str(e if isinstance(e, SyncErr) else SyncErr(e)))
 
     async def sync_all(self, ctx):
-        guild = await Guild.fetch_or_insert(self.db, ctx.message.guild.id)  # todo: move logic?
+        guild = await Guild.fetch_or_insert(ctx.db, ctx.message.guild.id)  # todo: move logic?
         challenges = await guild.fetch_challenges()
         BotErr.raise_if(guild.spreadsheet_key is None, 'Spreadsheet key is not set.') # todo: maybe its bad to have single
                                                                                             # spreadsheet_key per guild, maybe
                                                                                             # we need to store it in challange column
-        for c in challenges:
-            await export(guild.spreadsheet_key, c)
+        try:
+            await export_all(guild.spreadsheet_key, challenges)
+        except Exception as e:
+            raise SyncErr(e)
 
     async def set_award(self, ctx, url):
         state = await State.fetch(self, ctx, allow_started=True)
         await state.cc.set_award(url)
+        await ctx.db.commit()
+        challenge_state.on_challenge(state.guild.discord_id, state.cc)
 
     async def add_award(self, ctx, user, url):
         state = await State.fetch(self, ctx, allow_started=True)
@@ -545,51 +590,50 @@ class Bot(commands.Bot):
         user = await state.fetch_user(user)
         await user.remove_award(url)
 
+    async def check_state(self, ctx):
+        BotErr.raise_if(ctx.message.guild is None, 'Use this command in a server.')
+        return await challenge_state.check(ctx.db, ctx.message.guild.id)
+
     async def karma_graph(self, ctx, users):
-        # state = await State.fetch(self, ctx, allow_started=True)
-        sns.set_theme()
-        sns.set(style="darkgrid")
-        sns.set_context("talk")
-        sns.set_palette("tab10")
-        fig = plt.figure()
-        plt.xticks(rotation=90)
+        # A user mentioned twice is plotted once
+        users = list({ u.id: u for u in users }.values())
+        users = [ await User.fetch_or_insert(ctx.db, u.id, u.name) for u in users ]
+        latest = await KarmaHistory.fetch_latest_karma(ctx.db, [ u.id for u in users ])
         for user in users:
-            user = await User.fetch_or_insert(self.db, user.id, user.name) # todo: fix fetching user being state function # await state.fetch_user(user)
-            history = await KarmaHistory.fetch_karma_history(self.db, user.id)
-            if len(history) == 0:
+            if user.id not in latest:
                 await ctx.send(f'{user.name} has no karma history')
                 return
 
-            times = [ entry.time for entry in history ]
-            karmas = [ entry.karma for entry in history ]
-
-            a = open('tmp.txt', 'w')
-            a.write(','.join([str(x)for x in times]))
-            a.write('\n')
-            a.write(','.join([str(x)for x in karmas]))
-            plt.plot(times, karmas, label = user.name, marker='.')
-         
-        plt.legend()
-        pic_name = gen_fname('.png')
-        fig.savefig(pic_name, dpi=900, marker='.', bbox_inches='tight')
-        await ctx.send(file=File(pic_name))
-        os.remove(pic_name)
-        
+        key = (tuple((u.id, u.name) for u in users), tuple(latest[u.id] for u in users))
+        data = karma_graph.cached(key)
+        if data is None:
+            user_ids = [ u.id for u in users ]
+            axis, aligned = karma_graph.align(user_ids, *await KarmaHistory.fetch_histories(ctx.db, user_ids))
+            axis, aligned = karma_graph.downsample(axis, aligned)
+            data = await karma_graph.render(key, [ u.name for u in users ], axis, aligned)
+        await ctx.send(file=File(io.BytesIO(data), filename='karma_graph.png'))
+
 async def main():
     config = json.loads(open("config.json", 'rb').read())
     token = config["discord_token"]
     path = 'challenges.db'
     init_db = not os.path.isfile(path)
-    async with aiosqlite.connect(path, detect_types=sqlite3.PARSE_DECLTYPES) as connection:
+    async with aiosqlite.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=STATEMENT_CACHE_SIZE) as connection:
         if init_db:
             await connection.executescript(open('init.sql', 'r').read())
             await connection.commit()
+        await migrate(connection)
 
-        bot = Bot(Db(connection), config)
+        db = Db(connection)
+        await db.open_readers(path, config.get('sqlite_readers', 4), config.get('sqlite_pragmas', DEFAULT_PRAGMAS))
+        bot = Bot(db, config)
         try:
             await bot.start(token)
         finally:
             await bot.logout()
+            await db.close_readers()
+            hits, misses = db.estimated_statement_stats()
+            print(f'Statement cache (estimated): {hits} hits, {misses} misses')
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,184 @@
+import asyncio
+
+from db import Challenge, Guild, Participant, Pool, Round, User
+
+# Process-wide cache of what almost every command starts with: the guild, its current challenge
+# and that challenge's last round, participants, pools and bans. Rows are kept as plain tuples
+# and loaded into each command's session, so no relation is shared between sessions. Bot writes
+# through after committing its changes and calls invalidate() where a change is too involved
+# to mirror; check() compares a cached state with the database. Loads of a guild run one at a
+# time, and a load that saw a write-through or an invalidate() happen while it ran is dropped.
+
+states = {}   # guild discord id -> ChallengeState
+versions = {} # guild discord id -> number of changes seen, bumped by every hook and invalidate()
+locks = {}    # guild discord id -> lock held while the state of the guild is loaded
+MAX_LOAD_ATTEMPTS = 3
+
+def row(relation):
+    return tuple(getattr(relation, col) for col in relation.COLS)
+
+class ChallengeState:
+    def __init__(self, guild, challenge=None, has_started=False, last_round=None, users_participants=(), pools=(), banned_user_ids=()):
+        self.guild = row(guild)
+        self.challenge = None if challenge is None else row(challenge)
+        self.has_started = has_started
+        self.last_round = None if last_round is None else row(last_round)
+        self.users = {}        # discord id -> user row, for the participants
+        self.participants = {} # user id -> participant row
+        for u, p in users_participants:
+            self.users[u.discord_id] = row(u)
+            self.participants[u.id] = row(p)
+        self.pools = { p.id: row(p) for p in pools }
+        self.banned_user_ids = set(banned_user_ids)
+
+    def snapshot(self):
+        return (self.guild, self.challenge, self.has_started, self.last_round,
+            self.users, self.participants, self.pools, self.banned_user_ids)
+
+    def load_guild(self, db):
+        return db.load(Guild, self.guild)
+
+    def load_challenge(self, db):
+        return None if self.challenge is None else db.load(Challenge, self.challenge)
+
+    def load_last_round(self, db):
+        return None if self.last_round is None else db.load(Round, self.last_round)
+
+    def load_user(self, db, discord_id):
+        u = self.users.get(discord_id)
+        return None if u is None else db.load(User, u)
+
+    def load_participant(self, db, user_id):
+        p = self.participants.get(user_id)
+        return None if p is None else db.load(Participant, p)
+
+    def load_users_participants(self, db):
+        user_rows = { u[0]: u for u in self.users.values() }
+        return [ (db.load(User, user_rows[user_id]), db.load(Participant, p)) for user_id, p in self.participants.items() ]
+
+    def load_pool(self, db, name):
+        for p in self.pools.values():
+            if p[2] == name:
+                return db.load(Pool, p)
+        return None
+
+async def load(db, discord_id):
+    guild = await Guild.fetch_or_insert(db, discord_id)
+    async with db.read_transaction():
+        cc = await guild.fetch_current_challenge()
+        if cc is None:
+            return ChallengeState(guild)
+        return ChallengeState(guild, cc,
+            bool(await cc.has_started()),
+            await cc.fetch_last_round(),
+            await cc.fetch_users_participants(),
+            await cc.fetch_pools(),
+            [ u.id for u in await cc.fetch_banned_users() ])
+
+def bump(discord_id):
+    versions[discord_id] = versions.get(discord_id, 0) + 1
+
+async def reload(db, discord_id):
+    # Called with the lock of the guild held. Under constant writes the last load is
+    # still handed to the caller, it just isn't cached.
+    versions.setdefault(discord_id, 0)
+    for _ in range(MAX_LOAD_ATTEMPTS):
+        version = versions[discord_id]
+        state = await load(db, discord_id)
+        if versions[discord_id] == version:
+            states[discord_id] = state
+            return state
+        db.clear_cache()
+    return state
+
+async def fetch(db, discord_id):
+    if discord_id in states:
+        return states[discord_id]
+    async with locks.setdefault(discord_id, asyncio.Lock()):
+        if discord_id in states:
+            return states[discord_id]
+        return await reload(db, discord_id)
+
+async def check(db, discord_id):
+    # Reloads the state of the guild, returns whether the cached one matched it
+    async with locks.setdefault(discord_id, asyncio.Lock()):
+        cached = states.pop(discord_id, None)
+        state = await reload(db, discord_id)
+    return cached is None or cached.snapshot() == state.snapshot()
+
+def invalidate(discord_id):
+    bump(discord_id)
+    states.pop(discord_id, None)
+
+def on_guild(guild):
+    bump(guild.discord_id)
+    state = states.get(guild.discord_id)
+    if state is not None:
+        state.guild = row(guild)
+
+def on_challenge(discord_id, challenge):
+    bump(discord_id)
+    state = states.get(discord_id)
+    if state is not None and state.challenge is not None and state.challenge[0] == challenge.id:
+        state.challenge = row(challenge)
+
+def on_round(discord_id, round):
+    bump(discord_id)
+    state = states.get(discord_id)
+    if state is not None and state.challenge is not None and state.challenge[0] == round.challenge_id:
+        state.has_started = True
+        if state.last_round is None or state.last_round[1] <= round.num:
+            state.last_round = row(round)
+
+def on_participants(discord_id, participants):
+    bump(discord_id)
+    state = states.get(discord_id)
+    if state is not None:
+        for p in participants:
+            if p.user_id in state.participants:
+                state.participants[p.user_id] = row(p)
+
+def on_add_participant(discord_id, user, participant):
+    bump(discord_id)
+    state = states.get(discord_id)
+    if state is not None:
+        state.users[user.discord_id] = row(user)
+        state.participants[user.id] = row(participant)
+
+def on_remove_participant(discord_id, participant):
+    bump(discord_id)
+    state = states.get(discord_id)
+    if state is not None:
+        state.participants.pop(participant.user_id, None)
+        for discord_user_id, u in list(state.users.items()):
+            if u[0] == participant.user_id:
+                del state.users[discord_user_id]
+
+def on_pool(discord_id, pool):
+    bump(discord_id)
+    state = states.get(discord_id)
+    if state is not None:
+        state.pools[pool.id] = row(pool)
+
+def on_remove_pool(discord_id, pool):
+    bump(discord_id)
+    state = states.get(discord_id)
+    if state is not None:
+        state.pools.pop(pool.id, None)
+
+def on_ban(discord_id, user_id, is_banned):
+    bump(discord_id)
+    state = states.get(discord_id)
+    if state is not None:
+        if is_banned:
+            state.banned_user_ids.add(user_id)
+        else:
+            state.banned_user_ids.discard(user_id)
+
+def on_user(user):
+    # Users take part in challenges of several guilds
+    for discord_id in list(versions):
+        bump(discord_id)
+    for state in states.values():
+        if user.discord_id in state.users:
+            state.users[user.discord_id] = row(user)
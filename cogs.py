@@ -1,7 +1,7 @@
 import asyncio
+import io
 import uuid
 import re
-import os
 import random
 import math
 import discord
@@ -11,7 +11,7 @@ from discord.ext import commands
 from discord.ext.commands import UserConverter, CommandError
 from datetime import timedelta
 from html_profile.generator import generate_profile_html
-from html_profile.renderer import render_html_from_string
+from html_profile.renderer import RendererBusy
 from utils import is_valid_url
 
 class BotErr(CommandError):
@@ -38,6 +38,10 @@ class InvalidCog(BotErr):
     def __init__(self):
         super().__init__('Invalid cog name.')
 
+class SyncErr(BotErr):
+    def __init__(self, e):
+        super().__init__(f'Failed to sync with google sheets: {e}')
+
 class GuildAmbiguity(BotErr):
     def __init__(self, guilds):
         super().__init__('Guild ambiguity.')
@@ -360,8 +364,8 @@ class Admin(commands.Cog):
         Sets is_allowed_hidden to @val
         '''
         await self.bot.set_allow_hidden(ctx, val)
-        await self.bot.sync(ctx)
         await ctx.send('Done.')
+        await self.bot.sync(ctx)
 
     @commands.command()
     async def refill_title_info(self, ctx):
@@ -372,6 +376,17 @@ class Admin(commands.Cog):
         await self.bot.refill_title_info(ctx)
         await ctx.send('Done.')
 
+    @commands.command()
+    async def check_state(self, ctx):
+        '''
+        !check_state
+        [Admin only] Checks the cached challenge state against the database and reloads it
+        '''
+        if await self.bot.check_state(ctx):
+            await ctx.send('Cached state is consistent.')
+        else:
+            await ctx.send('Cached state was stale and has been reloaded.')
+
 # ----------------- User Cog ---------------------
 
 class User(commands.Cog):
@@ -442,10 +457,12 @@ class User(commands.Cog):
         avatar_url = str(user.avatar_url).replace("webp", "png")
         user, stats = await self.bot.user_profile(ctx, user)
         html_string = generate_profile_html(user, stats, avatar_url)
-        pic_name = render_html_from_string(html_string, css_path="./html_profile/styles.css")
-        
-        await ctx.send(file=File(pic_name))
-        os.remove(pic_name)
+        try:
+            data = await self.bot.profile_renderer.render(html_string)
+        except RendererBusy:
+            raise BotErr('Too many profiles are being rendered right now, try again in a bit.')
+
+        await ctx.send(file=File(io.BytesIO(data), filename='profile.jpg'))
 
     @commands.command()
     async def progress(self, ctx, *args):
@@ -537,7 +554,7 @@ class User(commands.Cog):
         if re.match(r'^#[a-fA-F0-9]{6}$', color) is None:
             return await ctx.send('Invalid color "{}".'.format(color))
 
-        await self.bot.set_color(user, color)
+        await self.bot.set_color(ctx, user, color)
         await ctx.send('Color has been changed.')
         await self.bot.sync(ctx)
 
@@ -563,7 +580,7 @@ class User(commands.Cog):
         if re.match(r'^[0-9a-zа-яA-ZА-Я_\-]+$', name) is None:
             return await ctx.send('Error: Bad symbols in your name.')
 
-        await self.bot.set_name(user, name)
+        await self.bot.set_name(ctx, user, name)
         await ctx.send(f'{user.mention} got "{name}" as a new name.')
         await self.bot.sync(ctx)
 
@@ -573,7 +590,7 @@ class User(commands.Cog):
         !sync
         Syncs current challenge with google sheets doc
         '''
-        await self.bot.sync(ctx)
+        await self.bot.flush_sync(ctx)
         await ctx.send('Done.')
 
     @commands.command()
@@ -729,7 +746,8 @@ class User(commands.Cog):
 
         args = [ arg for arg in args if arg != None ]
         if params['url']:
-            title_info = self.bot.get_api_title_info(params['url'])
+            title_info = await self.bot.get_api_title_info(ctx, params['url'])
+            BotErr.raise_if(title_info is None, f'Failed to get title info from {params["url"]}.')
             params['title_name'] = title_info.name
             params['score'] = title_info.score
             params['duration'] = title_info.duration
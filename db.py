@@ -1,38 +1,257 @@
 import aiosqlite
+import asyncio
+import contextvars
+import numpy as np
+import sqlite3
+import title_index
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
 from cogs import BotErr
-from fuzzywuzzy import process
+
+DEFAULT_PRAGMAS = {
+    'cache_size': -16000,   # KiB per connection
+    'mmap_size': 268435456,
+    'synchronous': 'NORMAL' # durable enough under WAL, and commits don't wait for fsync
+}
+STATEMENT_CACHE_SIZE = 128 # prepared statements kept by sqlite3 per connection
+
+# Every statement built from Queries templates, by name ('Guild.fetch_users')
+QUERIES = {}
 
 class Db:
+    # Writes go through one writer connection. Reads go to a pool of read-only connections once
+    # open_readers() is called, except while the writer holds uncommitted writes, which only
+    # the writer can see.
     def __init__(self, db):
         self.db = db
+        self.write_lock = asyncio.Lock()
+        self.readers = []
+        self.idle_readers = None
+        self.has_uncommitted = False
+        self.pinned_reader = contextvars.ContextVar('pinned_reader', default=None)
+        self.statements = {} # connection -> texts of its prepared statements, least recently used first
+        self.estimated_statement_hits = 0
+        self.estimated_statement_misses = 0
+
+    async def open_readers(self, path, num_readers, pragmas=DEFAULT_PRAGMAS):
+        await self.db.execute('PRAGMA journal_mode = WAL')
+        await apply_pragmas(self.db, pragmas)
+        self.idle_readers = asyncio.Queue()
+        for _ in range(num_readers):
+            reader = await aiosqlite.connect(f'file:{path}?mode=ro', uri=True, detect_types=sqlite3.PARSE_DECLTYPES,
+                cached_statements=STATEMENT_CACHE_SIZE)
+            await apply_pragmas(reader, pragmas)
+            self.readers.append(reader)
+            self.idle_readers.put_nowait(reader)
+
+    async def close_readers(self):
+        for reader in self.readers:
+            self.statements.pop(reader, None)
+            await reader.close()
+        self.readers = []
+        self.idle_readers = None
+
+    @asynccontextmanager
+    async def reader(self):
+        pinned = self.pinned_reader.get()
+        if pinned is not None:
+            yield pinned
+        elif self.idle_readers is None or self.has_uncommitted:
+            yield self.db
+        else:
+            reader = await self.idle_readers.get()
+            try:
+                yield reader
+            finally:
+                self.idle_readers.put_nowait(reader)
+
+    def estimate_statement(self, connection, query):
+        # Guesses whether sqlite3 reused a prepared statement by mirroring the LRU cache it keeps for
+        # each connection, keyed by the SQL text. sqlite3 doesn't expose its cache, so this is an estimate.
+        cached = self.statements.setdefault(connection, OrderedDict())
+        if query in cached:
+            self.estimated_statement_hits += 1
+            cached.move_to_end(query)
+        else:
+            self.estimated_statement_misses += 1
+            cached[query] = None
+            if len(cached) > STATEMENT_CACHE_SIZE:
+                cached.popitem(last=False)
+
+    def estimated_statement_stats(self):
+        return self.estimated_statement_hits, self.estimated_statement_misses
+
+    async def execute(self, query, *args):
+        async with self.write_lock:
+            self.has_uncommitted = True
+            self.estimate_statement(self.db, query)
+            return await self.db.execute(query, *args)
+
+    async def executemany(self, query, *args):
+        async with self.write_lock:
+            self.has_uncommitted = True
+            self.estimate_statement(self.db, query)
+            return await self.db.executemany(query, *args)
+
+    async def fetchrow(self, query, *args):
+        async with self.reader() as db:
+            self.estimate_statement(db, query)
+            async with db.execute(query, *args) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, query, *args):
+        async with self.reader() as db:
+            self.estimate_statement(db, query)
+            async with db.execute(query, *args) as cursor:
+                return await cursor.fetchall()
+
+    async def fetchval(self, *args, **kwargs):
+        col = kwargs['col'] if 'col' in kwargs else 0
+        row = await self.fetchrow(*args)
+        return None if row is None else row[col]
+
+    async def commit(self):
+        async with self.write_lock:
+            await self.db.commit()
+            self.has_uncommitted = False
+
+    @asynccontextmanager
+    async def read_transaction(self):
+        # All reads inside see the same state: on a reader they share one snapshot,
+        # on the writer writes wait until the reads are done
+        if self.pinned_reader.get() is not None:
+            yield self
+        elif self.idle_readers is None or self.has_uncommitted:
+            async with self.write_lock:
+                yield self
+        else:
+            async with self.reader() as reader:
+                self.estimate_statement(reader, 'BEGIN')
+                await reader.execute('BEGIN')
+                token = self.pinned_reader.set(reader)
+                try:
+                    yield self
+                finally:
+                    self.pinned_reader.reset(token)
+                    await reader.rollback()
+
+    def load(self, Class, row):
+        return Class(self, row)
+
+    async def save(self, relation):
+        update = relation.update_query()
+        if update is not None:
+            await self.execute(*update)
+            relation.changed.clear()
+
+    async def remove(self, relation):
+        await self.execute(*relation.delete_query())
+
+class Session:
+    # Unit of work over a Db: relations are kept in an identity map keyed by (table, primary key),
+    # reads are cached until the next write and updated relations are flushed together.
+    # discard() only drops the deferred updates. Statements already run through execute() stay
+    # on the shared writer until the next commit: commands interleave on that connection, so
+    # rolling it back could throw away another command's writes as well.
+    def __init__(self, db):
+        self.db = db
+        self.identity_map = {}
+        self.dirty = {}
+        self.cache = {}
 
     async def execute(self, *args):
+        await self.flush()
+        self.cache.clear()
         return await self.db.execute(*args)
 
     async def executemany(self, *args):
+        await self.flush()
+        self.cache.clear()
         return await self.db.executemany(*args)
 
     async def fetchrow(self, *args):
-        async with self.db.execute(*args) as cursor:
-            return await cursor.fetchone()
+        return await self._fetch(self.db.fetchrow, *args)
 
     async def fetchall(self, *args):
-        async with self.db.execute(*args) as cursor:
-            return await cursor.fetchall()
+        return await self._fetch(self.db.fetchall, *args)
 
     async def fetchval(self, *args, **kwargs):
         col = kwargs['col'] if 'col' in kwargs else 0
-        async with self.db.execute(*args) as cursor:
-            row = await cursor.fetchone()
-            return None if row is None else row[col]
+        row = await self.fetchrow(*args)
+        return None if row is None else row[col]
+
+    async def _fetch(self, fetch, query, params=()):
+        key = (fetch.__name__, query, tuple(params))
+        if key not in self.cache:
+            await self.flush()
+            self.cache[key] = await fetch(query, params)
+        return self.cache[key]
 
     async def commit(self):
+        await self.flush()
+        self.cache.clear()
         await self.db.commit()
 
+    def clear_cache(self):
+        # Lets the next reads see what other sessions committed since
+        self.cache.clear()
+
+    def discard(self):
+        # Drops the deferred updates of a command that failed, see above
+        self.dirty.clear()
+        self.cache.clear()
+
+    @asynccontextmanager
+    async def read_transaction(self):
+        await self.flush()
+        async with self.db.read_transaction():
+            yield self
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, {}
+        batches = {}
+        for relation in dirty.values():
+            update = relation.update_query()
+            if update is not None:
+                query, vals = update
+                batches.setdefault(query, []).append(vals)
+                relation.changed.clear()
+        for query, vals in batches.items():
+            await self.db.executemany(query, vals)
+
+    def load(self, Class, row):
+        relation = Class(self, row)
+        key = relation.identity()
+        if key not in self.identity_map:
+            self.identity_map[key] = relation
+        elif key not in self.dirty:
+            self.identity_map[key].refresh(row)
+        return self.identity_map[key]
+
+    async def save(self, relation):
+        if relation.changed:
+            self.dirty[relation.identity()] = relation
+            self.cache.clear()
+
+    async def remove(self, relation):
+        key = relation.identity()
+        self.dirty.pop(key, None)
+        self.identity_map.pop(key, None)
+        await self.execute(*relation.delete_query())
+
+async def apply_pragmas(connection, pragmas):
+    for name, value in pragmas.items():
+        await connection.execute(f'PRAGMA {name} = {value}')
+
 async def fromrow(Class, db, *args):
     row = await db.fetchrow(*args)
-    return None if row is None else Class(db, row)
+    return None if row is None else db.load(Class, row)
+
+async def fromrows(Class, db, *args):
+    return [db.load(Class, row) for row in await db.fetchall(*args)]
 
 class Cols:
     def __init__(self, *cols):
@@ -47,56 +266,136 @@ class Cols:
     def __str__(self):
         return self.join()
 
+    def __format__(self, prefix):
+        return self.join(prefix=prefix)
+
     def join(self, prefix='', sep=', ', suffix=''):
         return sep.join(map(lambda x: prefix + str(x) + suffix, self.cols))
 
-class Relation(object):
-    def __init__(self, db, name, all_cols, where_cols, row):
+class Queries:
+    # Named SQL templates of one class. Columns are written as {Title.COLS}, or {Title.COLS:T.}
+    # with a table alias. build_queries() formats every template once at import, and the
+    # statements are then read as attributes, e.g. Guild.SQL.fetch_users.
+    def __init__(self, **templates):
+        self.templates = templates
+
+    def build(self, owner, namespace):
+        for name, template in self.templates.items():
+            query = template.format(**namespace)
+            setattr(self, name, query)
+            QUERIES[f'{owner}.{name}'] = query
+
+class RelationMeta(type):
+    # Builds the row layout of every Relation subclass once, from its TABLE, KEY and COLS:
+    # a slot per column, so rows carry no per-instance dict, and the delete statement.
+    def __new__(meta, name, bases, namespace):
+        if 'COLS' in namespace:
+            namespace['__slots__'] = tuple(namespace['COLS'])
+        else:
+            namespace.setdefault('__slots__', ())
+        Class = super().__new__(meta, name, bases, namespace)
+        if 'COLS' in namespace:
+            table, key, cols = Class.TABLE, Class.KEY, Class.COLS
+            Class._set_cols = Cols(*[ col for col in cols if col not in key ])
+            Class._update_sqls = {} # changed columns, in COLS order -> UPDATE of just those columns
+            Class._delete_sql = f"DELETE FROM { table } WHERE { key.join(sep=' AND ', suffix='=?') }"
+        return Class
+
+class Relation(metaclass=RelationMeta):
+    # Assigned columns are tracked in `changed` until they are written, so an update only
+    # sets the columns that actually changed and is skipped when none did
+    __slots__ = ('db', 'changed')
+
+    def __init__(self, db, row):
         object.__setattr__(self, 'db', db)
-        assert len(all_cols) == len(row)
-        object.__setattr__(self, 'cols', { col: val for col, val in zip(all_cols, row) })
-
-        async def update():
-            updated_cols = Cols(*list(set(all_cols) - set(where_cols)))
-            query = f"UPDATE { name } SET { updated_cols.join(suffix='=?') } WHERE { where_cols.join(sep=' AND ', suffix='=?') }"
-            vals = [ self.cols[x] for x in updated_cols ] + [ self.cols[x] for x in where_cols ]
-            await db.execute(query, vals)
-
-        async def delete():
-            query = f"DELETE FROM { name } WHERE { where_cols.join(sep=' AND ', suffix='=?') }"
-            vals = [ self.cols[x] for x in where_cols ]
-            await db.execute(query, vals)
-            
-        object.__setattr__(self, 'update', update)
-        object.__setattr__(self, 'delete', delete)
-
-    def check_col(self, col):
-        if col not in self.cols:
-            raise AttributeError(f'Column "{col}" not found in "{self.__class__.__name__}" relation.')
-
-    def __getattr__(self, attr):
-        self.check_col(attr)
-        return self.cols[attr]
+        self.refresh(row)
+
+    def refresh(self, row):
+        assert len(self.COLS) == len(row)
+        for col, val in zip(self.COLS, row):
+            object.__setattr__(self, col, val)
+        object.__setattr__(self, 'changed', set())
+
+    def refresh_cols(self, **cols):
+        # For values already written by a bulk statement
+        for col, val in cols.items():
+            object.__setattr__(self, col, val)
+            self.changed.discard(col)
 
     def __setattr__(self, attr, val):
-        self.check_col(attr)
-        self.cols[attr] = val
+        if getattr(self, attr) != val:
+            object.__setattr__(self, attr, val)
+            self.changed.add(attr)
+
+    def identity(self):
+        return (self.TABLE,) + tuple(getattr(self, x) for x in self.KEY)
+
+    def update_query(self):
+        # None when no column has changed since the row was loaded or last written
+        cols = tuple(x for x in self._set_cols if x in self.changed)
+        if not cols:
+            return None
+        query = self._update_sqls.get(cols)
+        if query is None:
+            query = f"UPDATE { self.TABLE } SET { Cols(*cols).join(suffix='=?') } WHERE { self.KEY.join(sep=' AND ', suffix='=?') }"
+            self._update_sqls[cols] = query
+        vals = [ getattr(self, x) for x in cols ] + [ getattr(self, x) for x in self.KEY ]
+        return query, vals
+
+    def delete_query(self):
+        return self._delete_sql, [ getattr(self, x) for x in self.KEY ]
+
+    async def update(self):
+        await self.db.save(self)
+
+    async def delete(self):
+        await self.db.remove(self)
 
 class Guild(Relation):
+    TABLE = 'guild'
+    KEY = Cols('id')
     COLS = Cols('id', 'discord_id', 'current_challenge_id', 'spreadsheet_key')
+    SQL = Queries(
+        fetch='SELECT {Guild.COLS} FROM guild WHERE id = ?',
+        fetch_by_discord_id='SELECT {Guild.COLS} FROM guild WHERE discord_id = ?',
+        fetch_users='''
+            SELECT DISTINCT {User.COLS:U.} FROM user U
+            JOIN participant P ON U.id = P.user_id
+            JOIN challenge C ON C.id = P.challenge_id
+            WHERE C.guild_id = ?''',
+        fetch_users_karma='''
+            SELECT {User.COLS:U.}, COALESCE(K.karma, 0) karma
+            FROM user U
+            LEFT JOIN user_karma K ON K.user_id = U.id
+            WHERE U.id IN (
+                SELECT P.user_id FROM participant P
+                JOIN challenge C ON C.id = P.challenge_id
+                WHERE C.guild_id = ?)
+            ORDER BY karma DESC''',
+        fetch_titles='''
+            SELECT {Title.COLS:T.} FROM title T
+            JOIN pool P ON P.id = T.pool_id
+            JOIN challenge C ON C.id = P.challenge_id
+            WHERE C.guild_id = ? AND T.id > ?
+            ORDER BY T.id''',
+        fetch_challenge='SELECT {Challenge.COLS} FROM challenge WHERE guild_id=? AND name=?',
+        fetch_challenges='''
+            SELECT {Challenge.COLS:C.} FROM challenge C
+            WHERE C.guild_id = ?
+            ORDER BY C.start_time''')
+
+    @staticmethod
+    async def fetch(db, id):
+        return await fromrow(Guild, db, Guild.SQL.fetch, [id])
 
     @staticmethod
     async def fetch_or_insert(db, discord_id):
-        g =  await fromrow(Guild, db,
-            f'SELECT { Guild.COLS } FROM guild WHERE discord_id = ?', [discord_id])
+        g =  await fromrow(Guild, db, Guild.SQL.fetch_by_discord_id, [discord_id])
         if g is None:
             id = (await db.execute('INSERT INTO guild (discord_id) VALUES (?)', [discord_id])).lastrowid
-            g = Guild(db, [id, discord_id, None, None])
+            g = db.load(Guild, [id, discord_id, None, None])
         return g
 
-    def __init__(self, db, row):
-        super().__init__(db, 'guild', Guild.COLS, Cols('id'), row)
-
     async def fetch_current_challenge(self):
         return await Challenge.fetch_current_challenge(self.db, self.current_challenge_id)
 
@@ -106,39 +405,72 @@ class Guild(Relation):
     async def add_challenge(self, name, start_time):
         id = (await self.db.execute('INSERT INTO challenge (guild_id, name, start_time, allow_hidden) VALUES (?, ?, ?, ?)',
             [self.id, name, start_time, False])).lastrowid
-        return Challenge(self.db, [id, self.id, name, start_time, None, None, 1])
+        return self.db.load(Challenge, [id, self.id, name, start_time, None, None, 1])
 
     async def fetch_users(self):
-        rows = await self.db.fetchall(f'''
-            SELECT DISTINCT { User.COLS.join(prefix='U.') } FROM user U
-            JOIN participant P ON U.id = P.user_id
-            JOIN challenge C ON C.id = P.challenge_id
-            WHERE C.guild_id = ?''', [self.id])
-        return [User(self.db, row) for row in rows]
+        rows = await self.db.fetchall(self.SQL.fetch_users, [self.id])
+        return [self.db.load(User, row) for row in rows]
+
+    async def fetch_users_karma(self):
+        rows = await self.db.fetchall(self.SQL.fetch_users_karma, [self.id])
+        n = len(User.COLS)
+        return [(self.db.load(User, row[:n]), row[n]) for row in rows]
+
+    async def fetch_titles(self, after_id=0):
+        rows = await self.db.fetchall(self.SQL.fetch_titles, [self.id, after_id])
+        return [self.db.load(Title, row) for row in rows]
+
+    async def fetch_refill_checkpoint(self):
+        title_id = await self.db.fetchval('SELECT title_id FROM refill_checkpoint WHERE guild_id = ?', [self.id])
+        return 0 if title_id is None else title_id
+
+    async def set_refill_checkpoint(self, title_id):
+        if title_id is None:
+            await self.db.execute('DELETE FROM refill_checkpoint WHERE guild_id = ?', [self.id])
+        else:
+            await self.db.execute('INSERT OR REPLACE INTO refill_checkpoint (guild_id, title_id) VALUES (?, ?)',
+                [self.id, title_id])
 
     async def fetch_challenge(self, challenge_name):
-        return await fromrow(Challenge, self.db, f'''
-            SELECT {Challenge.COLS} FROM challenge WHERE guild_id=? AND name=?''', [self.id, challenge_name])
+        return await fromrow(Challenge, self.db, self.SQL.fetch_challenge, [self.id, challenge_name])
 
     async def fetch_challenges(self):
-        rows = await self.db.fetchall(f'''
-            SELECT { Challenge.COLS.join(prefix='C.') } FROM challenge C
-            WHERE C.guild_id = ?
-            ORDER BY C.start_time''', [self.id])
-        return [Challenge(self.db, row) for row in rows]
+        rows = await self.db.fetchall(self.SQL.fetch_challenges, [self.id])
+        return [self.db.load(Challenge, row) for row in rows]
+
+    async def fetch_karma_rolls(self):
+        return await self.db.fetchall('''
+            SELECT R.id, R.finish_time, PW.user_id, PP.user_id, RL.score, T.difficulty, PW.failed_round_id = R.id
+            FROM challenge C
+            JOIN round R ON R.challenge_id = C.id
+            JOIN roll RL ON RL.round_id = R.id
+            JOIN participant PW ON PW.id = RL.participant_id
+            JOIN title T ON T.id = RL.title_id
+            JOIN participant PP ON PP.id = T.participant_id
+            WHERE C.guild_id = ? AND R.is_finished
+            ORDER BY C.start_time, C.id, R.num, RL.participant_id''', [self.id])
 
 class User(Relation):
+    TABLE = 'user'
+    KEY = Cols('id')
     COLS = Cols('id', 'discord_id', 'color', 'name')
+    SQL = Queries(
+        fetch_by_discord_id='SELECT {User.COLS} FROM user WHERE discord_id = ?',
+        fetch_active_guilds='''
+            SELECT {Guild.COLS:G.}
+            FROM guild G
+            JOIN challenge C ON C.guild_id = G.id
+            JOIN participant P ON C.id = P.challenge_id
+            WHERE G.current_challenge_id IS NOT NULL AND C.id = G.current_challenge_id AND P.user_id = ? AND P.failed_round_id IS NULL''')
 
     @staticmethod
     async def fetch_or_insert(db, discord_id, name):
-        u = await fromrow(User, db, f'SELECT { User.COLS } FROM user WHERE discord_id = ?', [discord_id])
+        u = await fromrow(User, db, User.SQL.fetch_by_discord_id, [discord_id])
         if u is None:
             color = '#FFFFFF'
             id = (await db.execute('INSERT INTO user (discord_id, color, name) VALUES (?, ?, ?)',
                 [discord_id, color, name])).lastrowid
-            u = User(db, [id, discord_id, color, name])
-            u.update() #todo: fix id setting to null
+            u = db.load(User, [id, discord_id, color, name])
         return u
 
     async def add_award(self, award_url, time):
@@ -148,27 +480,46 @@ class User(Relation):
         await self.db.execute('DELETE FROM award WHERE url = ? AND user_id = ?', [award_url, self.id])
 
     async def fetch_active_guilds(self):
-        rows = await self.db.fetchall(f'''
-        SELECT { Guild.COLS.join(prefix='G.') }
-        FROM guild G
-        JOIN challenge C ON C.guild_id = G.id
-        JOIN participant P ON C.id = P.challenge_id 
-        WHERE G.current_challenge_id IS NOT NULL AND C.id = G.current_challenge_id AND P.user_id = ? AND P.failed_round_id IS NULL
-        ''', [self.id])
-        return [ Guild(self.db, row) for row in rows ]
-
-    def __init__(self, db, row):
-        super().__init__(db, 'user', User.COLS, Cols('id'), row)
+        rows = await self.db.fetchall(self.SQL.fetch_active_guilds, [self.id])
+        return [ self.db.load(Guild, row) for row in rows ]
 
 class Challenge(Relation):
+    TABLE = 'challenge'
+    KEY = Cols('id')
     COLS = Cols('id', 'guild_id', 'name', 'start_time', 'finish_time', 'award_url', 'allow_hidden')
+    SQL = Queries(
+        fetch='SELECT {Challenge.COLS} FROM challenge WHERE id = ?',
+        fetch_last_round='''
+            SELECT {Round.COLS} FROM round
+            WHERE challenge_id = ?
+            ORDER BY num DESC
+            LIMIT 1''',
+        fetch_rounds='''
+            SELECT {Round.COLS} FROM round
+            WHERE challenge_id = ?
+            ORDER BY num''',
+        fetch_pool='SELECT {Pool.COLS} FROM pool WHERE challenge_id = ? AND name = ?',
+        fetch_pools='SELECT {Pool.COLS} FROM pool WHERE challenge_id = ?',
+        fetch_titles='''
+            SELECT {Title.COLS:T.} FROM title T
+            JOIN pool P ON P.id = T.pool_id
+            WHERE P.challenge_id = ?''',
+        fetch_participant='SELECT {Participant.COLS} FROM participant P WHERE challenge_id = ? AND user_id = ?',
+        fetch_users_participants='''
+            SELECT {User.COLS:U.}, {Participant.COLS:P.}
+            FROM user U
+            JOIN participant P ON U.id = P.user_id
+            WHERE P.challenge_id = ?''',
+        fetch_participants='SELECT {Participant.COLS} FROM participant WHERE challenge_id = ?',
+        fetch_banned_users='''
+            SELECT {User.COLS:U.}
+            FROM banned_user BU
+            JOIN user U ON BU.user_id = U.id
+            WHERE BU.challenge_id = ?''')
 
     @staticmethod
     async def fetch_current_challenge(db, guild_id):
-        return await fromrow(Challenge, db, f'SELECT { Challenge.COLS } FROM challenge WHERE id = ?', [guild_id])
-
-    def __init__(self, db, row):
-        super().__init__(db, 'challenge', Challenge.COLS, Cols('id'), row)
+        return await fromrow(Challenge, db, Challenge.SQL.fetch, [guild_id])
 
     async def has_started(self):
         return await self.db.fetchval('''
@@ -177,34 +528,27 @@ class Challenge(Relation):
             WHERE C.id = ?''', [self.id])
 
     async def fetch_last_round(self):
-        return await fromrow(Round, self.db, f'''
-            SELECT { Round.COLS } FROM round
-            WHERE challenge_id = ?
-            ORDER BY num DESC
-            LIMIT 1''', [self.id])
+        return await fromrow(Round, self.db, self.SQL.fetch_last_round, [self.id])
 
     async def fetch_rounds(self):
-        rows = await self.db.fetchall(f'''
-            SELECT { Round.COLS } FROM round
-            WHERE challenge_id = ?
-            ORDER BY num''', [self.id])
-        return [Round(self.db, row) for row in rows]
+        rows = await self.db.fetchall(self.SQL.fetch_rounds, [self.id])
+        return [self.db.load(Round, row) for row in rows]
 
     async def add_round(self, num, start, finish):
         id = (await self.db.execute('INSERT INTO round (num, challenge_id, start_time, finish_time) VALUES (?, ?, ?, ?)',
             [num, self.id, start, finish])).lastrowid
-        return Round(self.db, [id, num, self.id, start, finish, False])
+        return self.db.load(Round, [id, num, self.id, start, finish, False])
 
     async def fetch_pool(self, pool_name):
-        return await fromrow(Pool, self.db,
-            f'SELECT { Pool.COLS } FROM pool WHERE challenge_id = ? AND name = ?', [self.id, pool_name])
+        return await fromrow(Pool, self.db, self.SQL.fetch_pool, [self.id, pool_name])
 
     async def fetch_pools(self):
-        rows = await self.db.fetchall(f'SELECT { Pool.COLS } FROM pool WHERE challenge_id = ?', [self.id])
-        return [Pool(self.db, row) for row in rows]
+        rows = await self.db.fetchall(self.SQL.fetch_pools, [self.id])
+        return [self.db.load(Pool, row) for row in rows]
 
     async def add_pool(self, pool_name):
-        await self.db.execute('INSERT INTO pool (challenge_id, name) VALUES (?, ?)', [self.id, pool_name])
+        id = (await self.db.execute('INSERT INTO pool (challenge_id, name) VALUES (?, ?)', [self.id, pool_name])).lastrowid
+        return self.db.load(Pool, [id, self.id, pool_name])
 
     async def has_pool(self, pool_name):
         return await self.db.fetchval('SELECT COUNT(1) FROM pool WHERE challenge_id = ? AND name = ?', [self.id, pool_name])
@@ -216,52 +560,49 @@ class Challenge(Relation):
             WHERE P.challenge_id = ? AND T.name = ?''', [self.id, title])
 
     async def fetch_title(self, title):
+        matches = await self.search_titles(title, limit=1)
+        return matches[0][0] if matches else None
+
+    async def search_titles(self, name, limit=5):
+        # [(title, score)] of the titles matching `name`, best first
+        index = await title_index.fetch_index(self.db, self.id)
+        matches = index.search(name, limit)
+        if not matches:
+            return []
         rows = await self.db.fetchall(f'''
-            SELECT { Title.COLS.join(prefix='T.') } FROM title T
-            JOIN pool P ON P.id = T.pool_id
-            WHERE P.challenge_id = ?''', [self.id])
-        name_to_id = { x[3]:i for i,x in enumerate(rows) }
-        match = process.extract(title, name_to_id.keys(), limit=1)
-        if match[0][1] < 60: # match threshold
-            return None # or raise error?
-        row = rows[name_to_id[match[0][0]]]
-        return Title(self.db, row)
+            SELECT { Title.COLS } FROM title
+            WHERE id IN ({ ', '.join('?' * len(matches)) })''', [m.title_id for m in matches])
+        titles = { row[0]: self.db.load(Title, row) for row in rows }
+        return [(titles[m.title_id], m.score) for m in matches if m.title_id in titles]
 
     async def fetch_titles(self):
-        rows = await self.db.fetchall(f'''
-            SELECT { Title.COLS.join(prefix='T.') } FROM title T
-            JOIN pool P ON P.id = T.pool_id
-            WHERE P.challenge_id = ?''', [self.id])
-        return [Title(self.db, row) for row in rows]
+        rows = await self.db.fetchall(self.SQL.fetch_titles, [self.id])
+        return [self.db.load(Title, row) for row in rows]
 
     async def has_participant(self, user_id):
         return await self.db.fetchval(
             'SELECT COUNT(1) FROM participant WHERE challenge_id = ? AND user_id = ?', [self.id, user_id])
 
     async def fetch_participant(self, user_id):
-        return await fromrow(Participant, self.db,
-            f'SELECT { Participant.COLS } FROM participant P WHERE challenge_id = ? AND user_id = ?', [self.id, user_id])
+        return await fromrow(Participant, self.db, self.SQL.fetch_participant, [self.id, user_id])
 
     async def fetch_users_participants(self):
-        rows = await self.db.fetchall(f'''
-            SELECT { User.COLS.join(prefix='U.') }, { Participant.COLS.join(prefix='P.') }
-            FROM user U
-            JOIN participant P ON U.id = P.user_id
-            WHERE P.challenge_id = ?''', [self.id])
+        rows = await self.db.fetchall(self.SQL.fetch_users_participants, [self.id])
         n = len(User.COLS)
-        return [(User(self.db, row[:n]), Participant(self.db, row[n:])) for row in rows]
+        return [(self.db.load(User, row[:n]), self.db.load(Participant, row[n:])) for row in rows]
 
     async def fetch_participants(self):
-        rows = await self.db.fetchall(f'SELECT { Participant.COLS } FROM participant WHERE challenge_id = ?', [self.id])
-        return [Participant(self.db, row) for row in rows]
+        rows = await self.db.fetchall(self.SQL.fetch_participants, [self.id])
+        return [self.db.load(Participant, row) for row in rows]
 
     async def add_participant(self, user_id):
         id = (await self.db.execute('INSERT INTO participant (challenge_id, user_id) VALUES (?, ?)',
             [self.id, user_id])).lastrowid
-        return Participant(self.db, [id, self.id, user_id, None, None, None])
+        return self.db.load(Participant, [id, self.id, user_id, None, None, None])
 
     async def set_award(self, award_url):
-        await self.db.execute('UPDATE challenge SET award_url = ? WHERE id = ?', [award_url, self.id])
+        self.award_url = award_url
+        await self.update()
 
     async def add_banned_user(self, user):
         await self.db.execute('INSERT INTO banned_user (user_id, challenge_id) VALUES(?,?)', [user.id, self.id])
@@ -270,14 +611,12 @@ class Challenge(Relation):
         await self.db.execute('DELETE FROM banned_user WHERE user_id = ? AND challenge_id = ?', [user.id, self.id])
 
     async def fetch_banned_users(self):
-        rows = await self.db.fetchall(f'''
-        SELECT { User.COLS.join(prefix='U.') }
-        FROM banned_user BU
-        JOIN user U ON BU.user_id = U.id
-        WHERE BU.challenge_id = ?''', [self.id])
-        return [ User(self.db, row) for row in rows ]
+        rows = await self.db.fetchall(self.SQL.fetch_banned_users, [self.id])
+        return [ self.db.load(User, row) for row in rows ]
 
 class Participant(Relation):
+    TABLE = 'participant'
+    KEY = Cols('id')
     COLS = Cols('id', 'challenge_id', 'user_id', 'failed_round_id', 'progress_current', 'progress_total')
 
     @staticmethod
@@ -285,57 +624,93 @@ class Participant(Relation):
         await db.executemany('UPDATE participant SET failed_round_id = ? WHERE id = ?',
             map(lambda x: (round_id, x), participant_ids))
 
-    def __init__(self, db, row):
-        super().__init__(db, 'participant', Participant.COLS, Cols('id'), row)
+    @staticmethod
+    async def reset_progress(db, participants):
+        for p in participants:
+            p.refresh_cols(progress_current=None, progress_total=None)
+        await db.execute(f'''
+            UPDATE participant SET progress_current = NULL, progress_total = NULL
+            WHERE id IN ({ ', '.join('?' * len(participants)) })''', [p.id for p in participants])
 
     def has_failed(self):
         return self.failed_round_id is not None
 
 class Pool(Relation):
+    TABLE = 'pool'
+    KEY = Cols('id')
     COLS = Cols('id', 'challenge_id', 'name')
+    SQL = Queries(
+        fetch_title='SELECT {Title.COLS} FROM title WHERE pool_id = ? AND name = ?',
+        fetch_titles='SELECT {Title.COLS} FROM title WHERE pool_id = ?',
+        fetch_unused_titles='SELECT {Title.COLS} FROM title WHERE pool_id = ? AND is_used = 0',
+        fetch_random_unused_titles='SELECT {Title.COLS} FROM title WHERE pool_id = ? AND is_used = 0 ORDER BY RANDOM() LIMIT ?')
 
-    def __init__(self, db, row):
-        super().__init__(db, 'pool', Pool.COLS, Cols('id'), row)
+    async def delete(self):
+        title_index.invalidate(self.challenge_id)
+        await super().delete()
 
     async def fetch_title(self, name):
-        return await fromrow(Title, self.db,
-            f'SELECT { Title.COLS } FROM title WHERE challenge_id = ? AND name = ?', [self.id, name])
+        return await fromrow(Title, self.db, self.SQL.fetch_title, [self.id, name])
 
     async def fetch_titles(self):
-        rows = await self.db.fetchall(f'SELECT { Title.COLS } FROM title WHERE pool_id = ?', [self.id])
-        return [Title(self.db, row) for row in rows]
+        rows = await self.db.fetchall(self.SQL.fetch_titles, [self.id])
+        return [self.db.load(Title, row) for row in rows]
 
     async def fetch_unused_titles(self):
-        rows = await self.db.fetchall(
-            f'SELECT { Title.COLS } FROM title WHERE pool_id = ? AND is_used = 0', [self.id])
-        return [Title(self.db, row) for row in rows]
+        rows = await self.db.fetchall(self.SQL.fetch_unused_titles, [self.id])
+        return [self.db.load(Title, row) for row in rows]
+
+    async def fetch_random_unused_titles(self, limit):
+        rows = await self.db.fetchall(self.SQL.fetch_random_unused_titles, [self.id, limit])
+        return [self.db.load(Title, row) for row in rows]
 
     async def add_title(self, participant_id, name, url, score, num_of_episodes, duration, difficulty, is_hidden, is_used=False):
         id = (await self.db.execute(
             '''INSERT INTO title (pool_id, participant_id, name, url, is_used, is_hidden, score, num_of_episodes, duration, difficulty)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
             [self.id, participant_id, name, url, is_used, is_hidden, score, num_of_episodes, duration, difficulty])).lastrowid
+        title_index.on_add(self.challenge_id, id, name)
 
-        return Title(self.db, [id, self.id, participant_id, name, url, is_used, is_hidden, score, duration, num_of_episodes, difficulty])
+        return self.db.load(Title, [id, self.id, participant_id, name, url, is_used, is_hidden, score, duration, num_of_episodes, difficulty])
 
 class Title(Relation):
+    TABLE = 'title'
+    KEY = Cols('id')
     COLS = Cols('id', 'pool_id', 'participant_id', 'name', 'url', 'is_used', 'is_hidden', 'score', 'duration', 'num_of_episodes', 'difficulty')
 
-    def __init__(self, db, row):
-        super().__init__(db, 'title', Title.COLS, Cols('id'), row)
+    @staticmethod
+    async def mark_used(db, titles):
+        for t in titles:
+            t.refresh_cols(is_used=True)
+        await db.execute(f'''
+            UPDATE title SET is_used = 1
+            WHERE id IN ({ ', '.join('?' * len(titles)) })''', [t.id for t in titles])
 
-class Round(Relation):
-    COLS = Cols('id', 'num', 'challenge_id', 'start_time', 'finish_time', 'is_finished')
+    async def rename(self, name):
+        self.name = name
+        await self.update()
+        title_index.on_rename(self.id, name)
 
-    def __init__(self, db, row):
-        super().__init__(db, 'round', Round.COLS, Cols('id'), row)
+    async def delete(self):
+        title_index.on_remove(self.id)
+        await super().delete()
 
-    async def fetch_rolls_watchers_proposers(self):
-        rows = await self.db.fetchall(f'''
+    @staticmethod
+    async def update_infos(db, infos):
+        await db.executemany('''
+            UPDATE title SET score = ?, duration = ?, num_of_episodes = ?, difficulty = ?
+            WHERE id = ?''', infos)
+
+class Round(Relation):
+    TABLE = 'round'
+    KEY = Cols('id')
+    COLS = Cols('id', 'num', 'challenge_id', 'start_time', 'finish_time', 'is_finished')
+    SQL = Queries(
+        fetch_rolls_watchers_proposers='''
             SELECT
-                { Roll.COLS.join(prefix='R.') },
-                { User.COLS.join(prefix='U1.') },
-                { User.COLS.join(prefix='U2.') }
+                {Roll.COLS:R.},
+                {User.COLS:U1.},
+                {User.COLS:U2.}
             FROM roll R
             JOIN participant P1 ON P1.id = R.participant_id
             JOIN user U1 ON U1.id = P1.user_id
@@ -344,190 +719,283 @@ class Round(Relation):
             JOIN participant P2 ON P2.id = T.participant_id
             JOIN user U2 ON U2.id = P2.user_id
 
-            WHERE R.round_id = ?''', [self.id])
+            WHERE R.round_id = ?''',
+        fetch_roll='SELECT {Roll.COLS} FROM roll WHERE round_id = ? AND participant_id = ?',
+        fetch_rolls='SELECT {Roll.COLS} FROM roll WHERE round_id = ?')
+
+    async def fetch_rolls_watchers_proposers(self):
+        rows = await self.db.fetchall(self.SQL.fetch_rolls_watchers_proposers, [self.id])
         n1 = len(Roll.COLS)
         n2 = n1 + len(User.COLS)
-        return [(Roll(self.db, row[:n1]), User(self.db, row[n1:n2]), User(self.db, row[n2:])) for row in rows]
+        return [(self.db.load(Roll, row[:n1]), self.db.load(User, row[n1:n2]), self.db.load(User, row[n2:])) for row in rows]
 
     async def fetch_roll(self, participant_id):
-        return await fromrow(Roll, self.db, 
-            f'SELECT { Roll.COLS } FROM roll WHERE round_id = ? AND participant_id = ?', [self.id, participant_id])
+        return await fromrow(Roll, self.db, self.SQL.fetch_roll, [self.id, participant_id])
 
     async def fetch_rolls(self):
-        rows = await self.db.fetchall(f'SELECT { Roll.COLS } FROM roll WHERE round_id = ?', [self.id])
-        return [Roll(self.db, row) for row in rows]
+        rows = await self.db.fetchall(self.SQL.fetch_rolls, [self.id])
+        return [self.db.load(Roll, row) for row in rows]
+
+    async def fetch_karma_rolls(self):
+        return await self.db.fetchall('''
+            SELECT PW.user_id, PP.user_id, R.score, T.difficulty, PW.failed_round_id = R.round_id
+            FROM roll R
+            JOIN participant PW ON PW.id = R.participant_id
+            JOIN title T ON T.id = R.title_id
+            JOIN participant PP ON PP.id = T.participant_id
+            WHERE R.round_id = ?
+            ORDER BY R.participant_id''', [self.id])
 
     async def add_roll(self, participant_id, title_id):
         await self.db.execute(
             'INSERT INTO roll (round_id, participant_id, title_id) VALUES (?, ?, ?)', [self.id, participant_id, title_id])
 
+    async def add_rolls(self, participant_title_ids):
+        await self.db.executemany('INSERT INTO roll (round_id, participant_id, title_id) VALUES (?, ?, ?)',
+            [(self.id, participant_id, title_id) for participant_id, title_id in participant_title_ids])
+
 class Roll(Relation):
+    TABLE = 'roll'
+    KEY = Cols('round_id', 'participant_id')
     COLS = Cols('round_id', 'participant_id', 'title_id', 'score')
-
-    def __init__(self, db, row):
-        super().__init__(db, 'roll', Roll.COLS, Cols('round_id', 'participant_id'), row)
-
-    async def fetch_title(self):
-        return await fromrow(Title, self.db, f'SELECT { Title.COLS } FROM title WHERE id = ?', [self.title_id])
-
-    async def fetch_user(self):
-        row = await self.db.fetchrow(f'''
-            SELECT { User.COLS.join(prefix='U.') }
+    SQL = Queries(
+        fetch_title='SELECT {Title.COLS} FROM title WHERE id = ?',
+        fetch_user='''
+            SELECT {User.COLS:U.}
             FROM roll R
             JOIN participant P ON P.id = R.participant_id
             JOIN user U ON P.user_id = U.id
-            WHERE R.round_id = ? AND R.participant_id = ?''', [self.round_id, self.participant_id])
-        return User(self.db, row)
-
-    async def fetch_participant(self):
-        row = await self.db.fetchrow(f'''
-            SELECT { Participant.COLS.join(prefix='P.') }
+            WHERE R.round_id = ? AND R.participant_id = ?''',
+        fetch_participant='''
+            SELECT {Participant.COLS:P.}
             FROM roll R
             JOIN participant P ON P.id = R.participant_id
-            WHERE R.round_id = ? AND R.participant_id = ?''', [self.round_id, self.participant_id])
-        return Participant(self.db, row)
-
-    async def fetch_title_author(self):          
-        row = await self.db.fetchrow(f'''
-            SELECT { User.COLS.join(prefix='U.') }
+            WHERE R.round_id = ? AND R.participant_id = ?''',
+        fetch_title_author='''
+            SELECT {User.COLS:U.}
             FROM roll R
             JOIN title T ON T.id = R.title_id
             JOIN participant P ON P.id = T.participant_id
             JOIN user U ON P.user_id = U.id
-            WHERE R.round_id = ? AND R.participant_id = ?''', [self.round_id, self.participant_id])
-        return User(self.db, row)
+            WHERE R.round_id = ? AND R.participant_id = ?''')
+
+    async def fetch_title(self):
+        return await fromrow(Title, self.db, self.SQL.fetch_title, [self.title_id])
+
+    async def fetch_user(self):
+        row = await self.db.fetchrow(self.SQL.fetch_user, [self.round_id, self.participant_id])
+        return self.db.load(User, row)
+
+    async def fetch_participant(self):
+        row = await self.db.fetchrow(self.SQL.fetch_participant, [self.round_id, self.participant_id])
+        return self.db.load(Participant, row)
+
+    async def fetch_title_author(self):          
+        row = await self.db.fetchrow(self.SQL.fetch_title_author, [self.round_id, self.participant_id])
+        return self.db.load(User, row)
 
 class KarmaHistory(Relation):
+    TABLE = 'karma_history'
+    KEY = Cols('user_id', 'time')
     COLS = Cols('user_id', 'karma', 'time')
 
-    def __init__(self, db, row):
-        super().__init__(db, 'karma_history', KarmaHistory.COLS, Cols('user_id', 'time'), row)
-
     @staticmethod
     async def fetch_user_karma(db, user_id):
-        rows = await db.fetchall(f'''
-            SELECT karma
-            FROM karma_history
-            WHERE user_id = ?
-            ORDER BY time DESC
-            LIMIT 1''', [user_id])
+        karma = await db.fetchval('SELECT karma FROM user_karma WHERE user_id = ?', [user_id])
+        return 0 if karma is None else karma # todo: maybe use constant -> starting_karma
 
-        if rows:
-            return rows[-1][0]
-        else:
-            return 0 # todo: maybe use constant -> starting_karma
+    @staticmethod
+    async def fetch_latest_karma(db, user_ids):
+        user_ids = list(user_ids)
+        rows = await db.fetchall(f'''
+            SELECT user_id, time, karma
+            FROM user_karma
+            WHERE user_id IN ({ ', '.join('?' * len(user_ids)) })''', user_ids)
+        return { row[0]: (row[1], row[2]) for row in rows }
 
     @staticmethod
-    async def clear_user_karma_history(db, user_id):
+    async def clear_users_karma_history(db, user_ids):
+        user_ids = list(user_ids)
         await db.execute(f'''
             DELETE FROM karma_history
-            WHERE user_id = ?''', [user_id])
+            WHERE user_id IN ({ ', '.join('?' * len(user_ids)) })''', user_ids)
 
     @staticmethod
-    async def insert_or_update_karma(db, user_id, karma, time):
-        row = await db.fetchrow(f'''
-            SELECT { KarmaHistory.COLS }
-            FROM karma_history
-            WHERE user_id = ? AND time = ?
-            ORDER BY time''', [user_id, time])
-
-        if row is None:
-            await db.execute('''
-                INSERT INTO karma_history
-                (user_id, karma, time)
-                VALUES(?, ?, ?)''', [user_id, karma, time])
-        else:
-            karma_history = KarmaHistory(db, row)
-            karma_history.karma = karma
-            await karma_history.update()
+    async def upsert_karma(db, rows):
+        await db.executemany('''
+            INSERT INTO karma_history (user_id, karma, time)
+            VALUES(?, ?, ?)
+            ON CONFLICT(user_id, time) DO UPDATE SET karma = excluded.karma''', rows)
 
     @staticmethod
-    async def fetch_karma_history(db, user_id):
+    async def fetch_histories(db, user_ids):
+        # Karma history of several users as columns: user ids, unix times and karma, ordered by user and time
+        user_ids = list(user_ids)
         rows = await db.fetchall(f'''
-            SELECT { KarmaHistory.COLS }
+            SELECT user_id, CAST(strftime('%s', time) AS INTEGER), karma
             FROM karma_history
-            WHERE user_id = ?
-            ORDER BY time''', [user_id])
-
-        return [KarmaHistory(db, row) for row in rows]
+            WHERE user_id IN ({ ', '.join('?' * len(user_ids)) })
+            ORDER BY user_id, time''', user_ids)
+        ids, times, karma = zip(*rows) if rows else ((), (), ())
+        return np.array(ids, dtype=np.int64), np.array(times, dtype='datetime64[s]'), np.array(karma, dtype=float)
+
+class ChallengeSnapshot:
+    # Everything an export needs, read in one transaction
+    SQL = Queries(
+        fetch_pools_titles='''
+            SELECT {Pool.COLS:P.}, {Title.COLS:T.}
+            FROM pool P
+            LEFT JOIN title T ON T.pool_id = P.id
+            WHERE P.challenge_id = ?
+            ORDER BY P.id, T.id''',
+        fetch_rounds_rolls='''
+            SELECT {Round.COLS:R.}, {Roll.COLS:RL.}
+            FROM round R
+            LEFT JOIN roll RL ON RL.round_id = R.id
+            WHERE R.challenge_id = ?
+            ORDER BY R.num, RL.participant_id''')
 
-class UserStats:
     @staticmethod
-    async def fetch(db, user_id, guild_id):
-        row = await db.fetchrow('''
-            SELECT COUNT(*), COALESCE(SUM(CASE WHEN P.failed_round_id IS NULL AND C.finish_time is NOT NULL THEN 1 ELSE 0 END),0) FROM challenge C
-            JOIN participant P ON P.challenge_id = C.id
-            WHERE P.user_id = ?''', [user_id])
-        num_challenges,num_completed = row
+    async def fetch(db, challenge):
+        async with db.read_transaction():
+            users_participants = await challenge.fetch_users_participants()
+            pool_rows = await db.fetchall(ChallengeSnapshot.SQL.fetch_pools_titles, [challenge.id])
+            round_rows = await db.fetchall(ChallengeSnapshot.SQL.fetch_rounds_rolls, [challenge.id])
+
+        n = len(Pool.COLS)
+        pools_titles = []
+        for row in pool_rows:
+            if not pools_titles or pools_titles[-1][0].id != row[0]:
+                pools_titles.append((db.load(Pool, row[:n]), []))
+            if row[n] is not None:
+                pools_titles[-1][1].append(db.load(Title, row[n:]))
+
+        n = len(Round.COLS)
+        rounds_rolls = []
+        for row in round_rows:
+            if not rounds_rolls or rounds_rolls[-1][0].id != row[0]:
+                rounds_rolls.append((db.load(Round, row[:n]), []))
+            if row[n] is not None:
+                rounds_rolls[-1][1].append(db.load(Roll, row[n:]))
+
+        return ChallengeSnapshot(challenge, users_participants, rounds_rolls, pools_titles)
+
+    def __init__(self, challenge, users_participants, rounds_rolls, pools_titles):
+        self.challenge = challenge
+        self.users_participants = users_participants
+        self.rounds_rolls = rounds_rolls
+        self.pools_titles = pools_titles
+        self.titles = [ t for _, titles in pools_titles for t in titles ]
+        self.has_started = len(rounds_rolls) > 0
 
-        avg_rate = await db.fetchval('''
-            SELECT AVG(R.score) FROM roll R
+class UserStats:
+    # Everything shown on a profile card, for one user or for all users of a guild at once.
+    # Counts and averages span all guilds, awards and the current round only the given one.
+    USER = 'SELECT ?'
+    GUILD_USERS = '''
+        SELECT DISTINCT P.user_id FROM participant P
+        JOIN challenge C ON C.id = P.challenge_id
+        WHERE C.guild_id = ?'''
+    STATS = '''
+        WITH users(id) AS ({users}),
+        challenges AS (
+            SELECT P.user_id, COUNT(*) num_challenges,
+                SUM(CASE WHEN P.failed_round_id IS NULL AND C.finish_time IS NOT NULL THEN 1 ELSE 0 END) num_completed
+            FROM participant P
+            JOIN challenge C ON C.id = P.challenge_id
+            WHERE P.user_id IN (SELECT id FROM users)
+            GROUP BY P.user_id),
+        rates AS (
+            SELECT P.user_id, AVG(R.score) avg_rate FROM roll R
             JOIN participant P ON P.id = R.participant_id
-            WHERE P.user_id = ? AND R.score IS NOT NULL''', [user_id])
-
-        avg_title_score = await db.fetchval('''
-            SELECT AVG(R.score) FROM roll R
+            WHERE P.user_id IN (SELECT id FROM users) AND R.score IS NOT NULL
+            GROUP BY P.user_id),
+        title_scores AS (
+            SELECT P.user_id, AVG(R.score) avg_title_score FROM roll R
             JOIN title T ON T.id = R.title_id
             JOIN participant P ON P.id = T.participant_id
-            WHERE P.user_id = ? AND R.score IS NOT NULL''', [user_id])
-
-        most_watched = await db.fetchall('''
-            SELECT U.name, COUNT(U.id) AS count FROM roll R
+            WHERE P.user_id IN (SELECT id FROM users) AND R.score IS NOT NULL
+            GROUP BY P.user_id),
+        last_round AS (
+            SELECT R.challenge_id, R.finish_time, R.is_finished FROM round R
+            JOIN guild G ON G.current_challenge_id = R.challenge_id
+            WHERE G.id = ?
+            ORDER BY R.num DESC LIMIT 1)
+        SELECT U.id, COALESCE(CH.num_challenges, 0), COALESCE(CH.num_completed, 0),
+            RA.avg_rate, TS.avg_title_score, COALESCE(K.karma, 0),
+            LR.finish_time, P.id IS NOT NULL AND P.failed_round_id IS NULL AND NOT LR.is_finished
+        FROM users U
+        LEFT JOIN challenges CH ON CH.user_id = U.id
+        LEFT JOIN rates RA ON RA.user_id = U.id
+        LEFT JOIN title_scores TS ON TS.user_id = U.id
+        LEFT JOIN user_karma K ON K.user_id = U.id
+        LEFT JOIN last_round LR
+        LEFT JOIN participant P ON P.challenge_id = LR.challenge_id AND P.user_id = U.id'''
+    LISTS = '''
+        WITH users(id) AS ({users}),
+        pairs AS (
+            SELECT P1.user_id watcher_id, P2.user_id proposer_id FROM roll R
             JOIN participant P1 ON P1.id = R.participant_id
-
             JOIN title T ON T.id = R.title_id
             JOIN participant P2 ON P2.id = T.participant_id
-            JOIN user U ON U.id = P2.user_id
-
-            WHERE P1.user_id = ?
-            GROUP BY U.id
-            ORDER BY count DESC LIMIT 6''', [user_id])
+            WHERE P1.user_id IN (SELECT id FROM users) OR P2.user_id IN (SELECT id FROM users)),
+        counts AS (
+            SELECT 'most_watched' kind, watcher_id user_id, proposer_id other_id, COUNT(*) count FROM pairs
+            WHERE watcher_id IN (SELECT id FROM users)
+            GROUP BY watcher_id, proposer_id
+            UNION ALL
+            SELECT 'most_sniped', proposer_id, watcher_id, COUNT(*) FROM pairs
+            WHERE proposer_id IN (SELECT id FROM users)
+            GROUP BY proposer_id, watcher_id),
+        ranked AS (
+            SELECT kind, user_id, other_id, count,
+                ROW_NUMBER() OVER (PARTITION BY kind, user_id ORDER BY count DESC, other_id) rank
+            FROM counts),
+        awards AS (
+            SELECT P.user_id, C.award_url url, C.finish_time time FROM challenge C
+            JOIN participant P ON P.challenge_id = C.id
+            WHERE P.user_id IN (SELECT id FROM users) AND C.guild_id = ?
+                AND P.failed_round_id IS NULL AND C.award_url IS NOT NULL
+            UNION
+            SELECT A.user_id, A.url, A.time FROM award A
+            WHERE A.user_id IN (SELECT id FROM users))
+        SELECT R.kind, R.user_id, U.name, R.count, R.rank FROM ranked R
+        JOIN user U ON U.id = R.other_id
+        WHERE R.rank <= 6
+        UNION ALL
+        SELECT 'awards', user_id, url, NULL, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY time) FROM awards
+        ORDER BY 1, 2, 5'''
+    SQL = Queries(
+        user_stats=STATS.format(users=USER),
+        user_lists=LISTS.format(users=USER),
+        guild_stats=STATS.format(users=GUILD_USERS),
+        guild_lists=LISTS.format(users=GUILD_USERS))
 
-        most_sniped = await db.fetchall('''
-            SELECT U.name, COUNT(U.id) AS count FROM roll R
-            JOIN participant P1 ON P1.id = R.participant_id
-            JOIN user U ON U.id = P1.user_id
+    @staticmethod
+    async def fetch(db, user_id, guild_id):
+        stats = await UserStats._fetch(db, UserStats.SQL.user_stats, UserStats.SQL.user_lists, [user_id], guild_id)
+        return stats[user_id]
 
-            JOIN title T ON T.id = R.title_id
-            JOIN participant P2 ON P2.id = T.participant_id
+    @staticmethod
+    async def fetch_guild(db, guild_id):
+        return await UserStats._fetch(db, UserStats.SQL.guild_stats, UserStats.SQL.guild_lists, [guild_id], guild_id)
 
-            WHERE P2.user_id = ?
-            GROUP BY U.id
-            ORDER BY count DESC LIMIT 6''', [user_id])
-
-        awards = await db.fetchall('''
-            SELECT * FROM (
-                SELECT C.award_url url, C.finish_time time FROM challenge C
-                JOIN participant P ON P.challenge_id = C.id
-                WHERE P.user_id = ? AND C.guild_id = ?
-                    AND P.failed_round_id IS NULL AND C.award_url IS NOT NULL
-                UNION
-                SELECT A.url url, A.time time from award A
-                JOIN user U ON A.user_id = U.id
-                WHERE A.user_id = ?
-            )
-            ORDER BY time''', [user_id, guild_id, user_id])
-        awards = [x[0] for x in awards]
-
-        karma = await KarmaHistory.fetch_user_karma(db, user_id)
-
-        finish_time = None
-        challenge = await Challenge.fetch_current_challenge(db, guild_id)
-        if challenge is not None:
-            last_round = await challenge.fetch_last_round()
-            participant = await challenge.fetch_participant(user_id)
-            if last_round is not None and participant is not None and not participant.has_failed and not last_round.is_finished:
-                finish_time = last_round.finish_time
-
-        return UserStats(num_challenges,
-                         num_completed,
-                         avg_rate,
-                         avg_title_score,
-                         most_watched,
-                         most_sniped,
-                         finish_time,
-                         karma,
-                         awards)
+    @staticmethod
+    async def _fetch(db, stats_query, lists_query, users_params, guild_id):
+        async with db.read_transaction():
+            rows = await db.fetchall(stats_query, users_params + [guild_id])
+            lists = await db.fetchall(lists_query, users_params + [guild_id])
+
+        stats = {}
+        for user_id, num_challenges, num_completed, avg_rate, avg_title_score, karma, finish_time, is_playing in rows:
+            stats[user_id] = UserStats(num_challenges, num_completed, avg_rate, avg_title_score,
+                [], [], finish_time if is_playing else None, karma, [])
+        for kind, user_id, value, count, _ in lists:
+            if kind == 'awards':
+                stats[user_id].awards.append(value)
+            else:
+                getattr(stats[user_id], kind).append((value, count))
+        return stats
 
     def __init__(self,
                  num_challenges,
@@ -547,4 +1015,13 @@ class UserStats:
         self.most_sniped = most_sniped
         self.finish_time = finish_time
         self.karma = karma
-        self.awards = awards
\ No newline at end of file
+        self.awards = awards
+
+def build_queries():
+    classes = [Guild, User, Challenge, Participant, Pool, Title, Round, Roll, KarmaHistory, ChallengeSnapshot, UserStats]
+    namespace = { Class.__name__: Class for Class in classes }
+    for Class in classes:
+        if 'SQL' in vars(Class):
+            Class.SQL.build(Class.__name__, namespace)
+
+build_queries()
@@ -1,14 +1,74 @@
 import pygsheets
 import asyncio
+import threading
+import json
+import os
 import re
 
 from pygsheets.exceptions import WorksheetNotFound
 from pygsheets.custom_types import HorizontalAlignment
 from pygsheets import Cell, DataRange
 from pygsheets.utils import format_addr
-from db import Challenge
+from concurrent.futures import ThreadPoolExecutor
+from db import ChallengeSnapshot
 
-gsheets_client = pygsheets.authorize()
+# All google sheets requests are blocking, so they're made from a small dedicated pool
+# and never from the event loop. The pool size also bounds how many sheets sync_all uploads at once.
+EXPORT_WORKERS = 4
+SHEETS_PER_BATCH = 5
+executor = None # created once, from sync_concurrency when configure() runs first
+local = threading.local()
+
+def gsheets_client():
+    # pygsheets' http client isn't thread safe, every export thread gets its own
+    if not hasattr(local, 'client'):
+        local.client = pygsheets.authorize()
+    return local.client
+
+# The last grid pushed to every worksheet, so only changed cells have to be sent.
+# (spreadsheet id, worksheet id) -> { (row, col): cell json }, optionally mirrored to export_cache_dir.
+CELL_FIELDS = 'userEnteredValue,userEnteredFormat'
+cache_dir = None
+grids = {}
+grid_locks = {}
+grids_lock = threading.Lock()
+
+def configure(config):
+    global cache_dir
+    cache_dir = config.get('export_cache_dir')
+    get_executor(config.get('sync_concurrency', EXPORT_WORKERS))
+
+def get_executor(workers=EXPORT_WORKERS):
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='export')
+    return executor
+
+def grid_lock(key):
+    with grids_lock:
+        if key not in grid_locks:
+            grid_locks[key] = threading.Lock()
+        return grid_locks[key]
+
+def grid_path(key):
+    return os.path.join(cache_dir, f'{key[0]}_{key[1]}.json')
+
+def load_grid(key):
+    if key not in grids and cache_dir is not None and os.path.isfile(grid_path(key)):
+        grid = json.loads(open(grid_path(key), 'r').read())
+        grids[key] = { tuple(map(int, k.split(','))): v for k, v in grid.items() }
+    return grids.get(key)
+
+def store_grid(key, grid):
+    if grid is None:
+        grids.pop(key, None)
+        if cache_dir is not None and os.path.isfile(grid_path(key)):
+            os.remove(grid_path(key))
+        return
+    grids[key] = grid
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        open(grid_path(key), 'w').write(json.dumps({ f'{r},{c}': v for (r, c), v in grid.items() }))
 
 def col2tuple(col):
     try:
@@ -112,7 +172,14 @@ def update_stats(stats, participant, score, num_rounds):
     n = 1 if n is None else n + 1
     stats[id] = (min_, max_, sum_, n)
 
-def sync_export(worksheet, users_participants, rounds_rolls, pools_titles, all_titles, allow_hidden):
+def sync_export(worksheet, snapshot):
+    push_sheets(worksheet.client, worksheet.spreadsheet.id, [(worksheet.id, worksheet.cols, build_cells(snapshot))])
+
+def build_cells(snapshot):
+    users_participants = snapshot.users_participants
+    rounds_rolls = snapshot.rounds_rolls
+    allow_hidden = not snapshot.has_started and snapshot.challenge.allow_hidden
+
     writer = ColWriter(users_participants)
     writer.write_header('Participants')
     sorted_participants = list(map(lambda x: x[1], sorted(users_participants, key=lambda x: x[0].name)))
@@ -121,7 +188,7 @@ def sync_export(worksheet, users_participants, rounds_rolls, pools_titles, all_t
         writer.write_participant(participant)
     writer.next_col()
 
-    titles = { t.id: t for t in all_titles }
+    titles = { t.id: t for t in snapshot.titles }
     stats = {}
     for round, rolls in rounds_rolls:
         roll_by_participant_id = { r.participant_id: r for r in rolls }
@@ -150,31 +217,104 @@ def sync_export(worksheet, users_participants, rounds_rolls, pools_titles, all_t
             writer.write_score(stat)
         writer.next_col()
 
-    for pool, titles in pools_titles:
+    for pool, titles in snapshot.pools_titles:
         writer.write_header(f'{ pool.name } (unused titles)')
         for title in titles:
             if not title.is_used:
                 writer.write_title(title, allow_hidden=allow_hidden)
         writer.next_col()
 
-    # Cell((0, 0)) clears the entire screen
-    worksheet.update_cells([Cell((0, 0))] + writer.cells)
-    worksheet.adjust_column_width(1, worksheet.cols)
+    return writer.cells
 
-async def export(spreadsheet_key, challenge):
-    spreadsheet = gsheets_client.open_by_key(spreadsheet_key)
+def cell_runs(cells):
+    # Groups cells into runs of consecutive rows within a column
+    runs = []
+    for (row, col), data in sorted(cells.items(), key=lambda x: (x[0][1], x[0][0])):
+        if runs and runs[-1][1] == col and runs[-1][0] + len(runs[-1][2]) == row:
+            runs[-1][2].append(data)
+        else:
+            runs.append((row, col, [data]))
+    return runs
+
+def sheet_requests(sheet_id, num_cols, old_grid, new_grid):
+    requests = []
+    if old_grid is None:
+        old_grid = {}
+        requests.append({ 'updateCells': { 'range': { 'sheetId': sheet_id }, 'fields': '*' } }) # clears the entire sheet
+
+    changes = { k: json.loads(v) for k, v in new_grid.items() if old_grid.get(k) != v }
+    changes.update({ k: {} for k in old_grid if k not in new_grid })
+    for row, col, values in cell_runs(changes):
+        requests.append({ 'updateCells': {
+            'range': { 'sheetId': sheet_id, 'startRowIndex': row, 'endRowIndex': row + len(values),
+                       'startColumnIndex': col, 'endColumnIndex': col + 1 },
+            'rows': [ { 'values': [value] } for value in values ],
+            'fields': CELL_FIELDS } })
+
+    if requests:
+        requests.append({ 'autoResizeDimensions': { 'dimensions': {
+            'sheetId': sheet_id, 'dimension': 'COLUMNS', 'startIndex': 0, 'endIndex': num_cols } } })
+    return requests
+
+def push_sheets(client, spreadsheet_id, sheets):
+    # Sends the changes of several worksheets as one atomic batch update.
+    # sheets: [(worksheet id, number of columns, cells)]
+    keys = [ (spreadsheet_id, sheet_id) for sheet_id, _, _ in sheets ]
+    locks = [ grid_lock(key) for key in sorted(set(keys)) ]
+    for lock in locks:
+        lock.acquire()
     try:
-        worksheet = spreadsheet.worksheet_by_title(challenge.name)
+        requests = []
+        new_grids = []
+        for (sheet_id, num_cols, cells), key in zip(sheets, keys):
+            new_grid = { (c.row - 1, c.col - 1): json.dumps(c.get_json(), sort_keys=True) for c in cells }
+            requests += sheet_requests(sheet_id, num_cols, load_grid(key), new_grid)
+            new_grids.append((key, new_grid))
+        if requests:
+            try:
+                client.sheet.batch_update(spreadsheet_id, requests)
+            except:
+                for key, _ in new_grids:
+                    store_grid(key, None) # the sheet's state is unknown, next sync rewrites it
+                raise
+        for key, new_grid in new_grids:
+            store_grid(key, new_grid)
+    finally:
+        for lock in locks:
+            lock.release()
+
+def open_worksheet(spreadsheet_key, title):
+    spreadsheet = gsheets_client().open_by_key(spreadsheet_key)
+    try:
+        return spreadsheet.worksheet_by_title(title)
     except WorksheetNotFound:
-        worksheet = spreadsheet.add_worksheet(challenge.name)
-
-    has_started = await challenge.has_started()
-    users_participants = await challenge.fetch_users_participants()
-    pools = await challenge.fetch_pools()
-    pool_titles = [ await pool.fetch_titles() for pool in pools ]
-    pools_titles = list(zip(pools, pool_titles))
-    all_titles = [ t for pt in pool_titles for t in pt ]
-    rounds = await challenge.fetch_rounds()
-    rounds_rolls = list(zip(rounds, [ await round.fetch_rolls() for round in rounds ]))
-
-    sync_export(worksheet, users_participants, rounds_rolls, pools_titles, all_titles, (not has_started and challenge.allow_hidden))
\ No newline at end of file
+        return spreadsheet.add_worksheet(title)
+
+def upload(spreadsheet_key, title, *args):
+    sync_export(open_worksheet(spreadsheet_key, title), *args)
+
+def open_worksheets(spreadsheet_key, titles):
+    spreadsheet = gsheets_client().open_by_key(spreadsheet_key)
+    worksheets = { ws.title: ws for ws in spreadsheet.worksheets() }
+    for title in titles:
+        if title not in worksheets:
+            worksheets[title] = spreadsheet.add_worksheet(title)
+    return spreadsheet.id, [ (worksheets[t].id, worksheets[t].cols) for t in titles ]
+
+def upload_batch(spreadsheet_id, sheets):
+    push_sheets(gsheets_client(), spreadsheet_id,
+        [ (sheet_id, num_cols, build_cells(snapshot)) for sheet_id, num_cols, snapshot in sheets ])
+
+async def export(spreadsheet_key, challenge):
+    snapshot = await ChallengeSnapshot.fetch(challenge.db, challenge)
+    await asyncio.get_event_loop().run_in_executor(get_executor(), upload, spreadsheet_key, challenge.name, snapshot)
+
+async def export_all(spreadsheet_key, challenges):
+    loop = asyncio.get_event_loop()
+    snapshots = [ await ChallengeSnapshot.fetch(c.db, c) for c in challenges ]
+    spreadsheet_id, worksheets = await loop.run_in_executor(get_executor(), open_worksheets, spreadsheet_key,
+        [ c.name for c in challenges ])
+
+    sheets = [ (sheet_id, num_cols, snapshot) for (sheet_id, num_cols), snapshot in zip(worksheets, snapshots) ]
+    batches = [ sheets[i:i + SHEETS_PER_BATCH] for i in range(0, len(sheets), SHEETS_PER_BATCH) ]
+    await asyncio.gather(*[ loop.run_in_executor(get_executor(), upload_batch, spreadsheet_id, b) for b in batches ])
@@ -0,0 +1,96 @@
+import asyncio
+import hashlib
+import os
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class ProfileImageCache:
+    # Rendered cards keyed by the sha256 of the stylesheet and the generated html. The html holds
+    # everything shown on the card (stats, colors, avatar and award urls), so a changed card gets
+    # a new key and old images simply age out. Recently used images are kept in memory, the rest
+    # optionally on disk; both tiers evict the least recently used image.
+    def __init__(self, css_path, memory_size=32, cache_dir=None, disk_size=1000):
+        self.memory_size = memory_size
+        self.cache_dir = cache_dir
+        self.disk_size = disk_size
+        self.memory = OrderedDict() # key -> image bytes
+        self.disk = OrderedDict()   # key -> None, in the order the files were last used
+        # One thread, so file operations run in the order they were asked for and a hit
+        # never waits behind a render
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='profile-cache')
+        with open(css_path, 'rb') as f:
+            self.css_digest = hashlib.sha256(f.read()).digest()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            paths = [os.path.join(cache_dir, fname) for fname in os.listdir(cache_dir) if fname.endswith('.jpg')]
+            for path in sorted(paths, key=os.path.getmtime):
+                self.disk[os.path.basename(path)[:-len('.jpg')]] = None
+
+    def key(self, html_string):
+        h = hashlib.sha256(self.css_digest)
+        h.update(html_string.encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.jpg')
+
+    async def get(self, key):
+        data = self.memory.get(key)
+        if data is not None:
+            self.memory.move_to_end(key)
+            return data
+        if key not in self.disk:
+            return None
+        data = await asyncio.get_event_loop().run_in_executor(self.executor, self.read, key)
+        if data is None:
+            self.disk.pop(key, None)
+            return None
+        if key in self.disk:
+            self.disk.move_to_end(key)
+        self.remember(key, data)
+        return data
+
+    async def put(self, key, data):
+        self.remember(key, data)
+        if self.cache_dir is None:
+            return
+        self.disk[key] = None
+        self.disk.move_to_end(key)
+        evicted = []
+        while len(self.disk) > self.disk_size:
+            old_key, _ = self.disk.popitem(last=False)
+            evicted.append(old_key)
+        await asyncio.get_event_loop().run_in_executor(self.executor, self.write, key, data, evicted)
+
+    # read and write run on the cache's own thread, the index above is only touched on the event loop
+
+    def read(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self.path(key))
+        except OSError:
+            return None
+        return data
+
+    def write(self, key, data, evicted):
+        # Written under a temporary name first so a crash never leaves a truncated image behind
+        tmp_path = self.path(key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(key))
+        for old_key in evicted:
+            try:
+                os.remove(self.path(old_key))
+            except OSError:
+                pass
+
+    def remember(self, key, data):
+        self.memory[key] = data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
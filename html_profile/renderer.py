@@ -1,20 +1,96 @@
+import asyncio
 import imgkit
-import hashlib
-import random
 
-from utils import gen_fname
+from concurrent.futures import ThreadPoolExecutor
+
+OPTIONS = {
+    "enable-local-file-access": None,
+    "height": 1000,
+    "width": 1800,
+    "disable-smart-width": None,
+    "quality": 100,
+    "zoom": 4,
+    "quiet": None,
+    "format": "jpg",
+}
 
 def render_html_from_string(html_string, css_path):
-    options = {
-        "enable-local-file-access": None,
-        "height": 1000,
-        "width": 1800,
-        "disable-smart-width": None,
-        "quality": 100,
-        "zoom": 4,
-        "quiet": None,
-    }
-
-    fname = gen_fname('.jpg')
-    imgkit.from_string(html_string, fname, options=options, css=css_path)
-    return fname
+    # Passing False as the output path makes imgkit return the image instead of writing a file
+    return imgkit.from_string(html_string, False, options=OPTIONS, css=css_path)
+
+class RendererBusy(Exception):
+    pass
+
+class ProfileRenderer:
+    # wkhtmltoimage can't stay up between renders, so the pool is a fixed set of worker tasks,
+    # each running one render at a time in its own thread. Requests wait in a bounded queue
+    # and are refused with RendererBusy once it is full.
+    def __init__(self, css_path, workers=2, queue_size=8, cache=None):
+        self.css_path = css_path
+        self.cache = cache
+        self.pending = {} # cache key -> future of the render in progress, shared by identical requests
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='render')
+        self.queue = None
+        self.tasks = []
+
+    def start(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue(self.queue_size)
+            self.tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def render(self, html_string):
+        if self.cache is None:
+            return await self.enqueue(html_string)
+
+        key = self.cache.key(html_string)
+        data = await self.cache.get(key)
+        if data is not None:
+            return data
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+
+        future = self.enqueue(html_string)
+        self.pending[key] = future
+        try:
+            data = await asyncio.shield(future)
+        finally:
+            self.pending.pop(key, None)
+        await self.cache.put(key, data)
+        return data
+
+    def enqueue(self, html_string):
+        self.start()
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self.queue.put_nowait((html_string, future))
+        except asyncio.QueueFull:
+            raise RendererBusy()
+        return future
+
+    async def _work(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            html_string, future = await self.queue.get()
+            try:
+                # The requester may have given up while the request was queued
+                if not future.cancelled():
+                    data = await loop.run_in_executor(self.executor, render_html_from_string, html_string, self.css_path)
+                    if not future.cancelled():
+                        future.set_result(data)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.queue = None
+        self.executor.shutdown(wait=False)
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,49 @@
+from itertools import groupby
+from db import KarmaHistory
+
+FAIL_PENALTY = 25
+
+def roll_events(rows):
+    # Karma changes of a round's rolls in the order Bot.calc_karma used to apply them.
+    events = []
+    for watcher_id, proposer_id, score, difficulty, has_failed in rows:
+        if has_failed:
+            events.append((watcher_id, -FAIL_PENALTY))
+        if score is not None:
+            events.append((watcher_id, difficulty // 10))
+            events.append((proposer_id, -(difficulty // 20)))
+    return events
+
+class KarmaEngine:
+    def __init__(self, latest):
+        self.latest = latest # user_id -> (time, karma) of the newest karma_history row
+        self.history = {}    # (user_id, time) -> karma to be written
+
+    def apply(self, time, events):
+        for user_id, delta in events:
+            latest_time, karma = self.latest.get(user_id, (None, 0))
+            karma += delta
+            self.history[(user_id, time)] = karma
+            if latest_time is None or time >= latest_time:
+                self.latest[user_id] = (time, karma)
+
+    async def write(self, db):
+        await KarmaHistory.upsert_karma(db, [ (u, k, t) for (u, t), k in self.history.items() ])
+
+async def calc_round_karma(db, round):
+    rows = await round.fetch_karma_rolls()
+    events = roll_events(rows)
+    engine = KarmaEngine(await KarmaHistory.fetch_latest_karma(db, { e[0] for e in events }))
+    engine.apply(round.finish_time, events)
+    await engine.write(db)
+
+async def recalc_guild_karma(db, guild):
+    users = await guild.fetch_users()
+    await KarmaHistory.clear_users_karma_history(db, [ u.id for u in users ])
+
+    rows = await guild.fetch_karma_rolls()
+    engine = KarmaEngine(await KarmaHistory.fetch_latest_karma(db, { x for r in rows for x in r[2:4] }))
+    for _, round_rows in groupby(rows, key=lambda r: r[0]):
+        round_rows = list(round_rows)
+        engine.apply(round_rows[0][1], roll_events([ r[2:] for r in round_rows ]))
+    await engine.write(db)
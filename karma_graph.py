@@ -0,0 +1,124 @@
+import asyncio
+import io
+import multiprocessing
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import seaborn as sns
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+GRAPH_WORKERS = 1
+CACHE_SIZE = 32
+MAX_POINTS = 500 # per user, longer histories are downsampled before plotting
+
+# Spawned rather than forked, so the worker doesn't inherit the bot's sqlite/export threads and sockets
+executor = ProcessPoolExecutor(max_workers=GRAPH_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+# (users, newest karma of each user) -> png bytes
+cache = OrderedDict()
+
+is_themed = False
+
+def pick_dpi(num_points):
+    # Dense graphs get more pixels so the points stay apart, sparse ones stay small
+    if num_points <= 200:
+        return 150
+    if num_points <= 1000:
+        return 200
+    return 300
+
+def align(user_ids, ids, times, karma):
+    # Puts each user's history on one time axis shared by all users: a row per user, a column
+    # per distinct time, NaN where the user has no entry at that time. user_ids must be distinct.
+    axis = np.unique(times)
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    order = np.argsort(user_ids)
+    rows = order[np.searchsorted(user_ids[order], ids)]
+    aligned = np.full((len(user_ids), len(axis)), np.nan)
+    aligned[rows, np.searchsorted(axis, times)] = karma
+    return axis, aligned
+
+def lttb(x, y, num_points):
+    # Indices of the points of (x, y) kept by largest-triangle-three-buckets: the first and the last
+    # point, plus from each bucket in between the point making the largest triangle with the point
+    # kept before it and the average of the next bucket
+    size = len(x)
+    if size <= num_points or num_points < 3:
+        return np.arange(size)
+    edges = np.linspace(1, size - 1, num_points - 1).astype(int)
+    kept = [0]
+    for i in range(num_points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i == num_points - 3:
+            next_x, next_y = x[-1], y[-1]
+        else:
+            next_x, next_y = x[hi:edges[i + 2]].mean(), y[hi:edges[i + 2]].mean()
+        a = kept[-1]
+        area = np.abs((x[a] - next_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y - y[a]))
+        kept.append(lo + int(np.argmax(area)))
+    kept.append(size - 1)
+    return np.array(kept)
+
+def bucket_max(axis, aligned, num_points):
+    # Splits the axis into num_points buckets and keeps each user's highest karma in every bucket,
+    # placed at the bucket's last time
+    if len(axis) <= num_points:
+        return axis, aligned
+    starts = np.linspace(0, len(axis), num_points, endpoint=False).astype(int)
+    ends = np.append(starts[1:], len(axis)) - 1
+    with np.errstate(invalid='ignore'):
+        return axis[ends], np.fmax.reduceat(aligned, starts, axis=1)
+
+def downsample(axis, aligned, num_points=MAX_POINTS, method='lttb'):
+    if len(axis) <= num_points:
+        return axis, aligned
+    if method == 'max':
+        return bucket_max(axis, aligned, num_points)
+    # LTTB runs per user; the union of the kept columns keeps the users aligned
+    x = axis.astype(np.int64).astype(float)
+    kept = set()
+    for row in aligned:
+        present = np.flatnonzero(~np.isnan(row))
+        kept.update(present[lttb(x[present], row[present], num_points)])
+    kept = np.array(sorted(kept), dtype=int)
+    return axis[kept], aligned[:, kept]
+
+def render_png(labels, axis, aligned):
+    # Runs in the worker process. One row of `aligned` per label, NaN where a user has no point
+    global is_themed
+    if not is_themed:
+        sns.set_theme(style='darkgrid', context='talk', palette='tab10')
+        is_themed = True
+
+    fig = plt.figure()
+    try:
+        ax = fig.gca()
+        for label, row in zip(labels, aligned):
+            present = ~np.isnan(row)
+            ax.plot(axis[present], row[present], label=label, marker='.')
+        ax.tick_params(axis='x', labelrotation=90)
+        ax.legend()
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', dpi=pick_dpi(int((~np.isnan(aligned)).sum())), bbox_inches='tight')
+        return buf.getvalue()
+    finally:
+        plt.close(fig)
+
+def cached(key):
+    data = cache.get(key)
+    if data is not None:
+        cache.move_to_end(key)
+    return data
+
+async def render(key, labels, axis, aligned):
+    data = await asyncio.get_event_loop().run_in_executor(executor, render_png, labels, axis, aligned)
+    cache[key] = data
+    while len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+    return data
+
+def clear_cache():
+    cache.clear()
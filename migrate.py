@@ -0,0 +1,33 @@
+import os
+import re
+
+MIGRATIONS_DIR = 'migrations'
+
+def list_migrations(path=MIGRATIONS_DIR):
+    migrations = []
+    for fname in os.listdir(path):
+        m = re.match(r'^(\d+)_.*\.sql$', fname)
+        if m:
+            migrations.append((int(m[1]), os.path.join(path, fname)))
+    return sorted(migrations)
+
+async def fetch_version(connection):
+    async with connection.execute('PRAGMA user_version') as cursor:
+        return (await cursor.fetchone())[0]
+
+# Schema version is kept in sqlite's user_version, init.sql is version 0.
+# Every migration runs in its own transaction together with the version bump.
+async def migrate(connection, path=MIGRATIONS_DIR):
+    version = await fetch_version(connection)
+    for num, fname in list_migrations(path):
+        if num <= version:
+            continue
+        print(f'Applying migration {os.path.basename(fname)}')
+        script = open(fname, 'r').read()
+        try:
+            await connection.executescript(f'BEGIN;\n{script}\nPRAGMA user_version = {num};\nCOMMIT;')
+        except:
+            await connection.rollback()
+            raise
+        version = num
+    return version
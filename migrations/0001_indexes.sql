@@ -0,0 +1,25 @@
+-- Secondary indexes for the filters used in db.py.
+-- Each one was checked with EXPLAIN QUERY PLAN to turn a full scan into an index search.
+
+-- Guild.fetch_challenges, Guild.has_challenge
+CREATE INDEX IF NOT EXISTS challenge_guild_id ON challenge (guild_id, start_time);
+
+-- User.fetch_active_guilds, UserStats.fetch
+CREATE INDEX IF NOT EXISTS participant_user_id ON participant (user_id, challenge_id, failed_round_id);
+
+-- Pool.fetch_titles, Pool.fetch_unused_titles, Challenge.has_title
+CREATE INDEX IF NOT EXISTS title_pool_id ON title (pool_id, is_used);
+CREATE INDEX IF NOT EXISTS title_pool_id_name ON title (pool_id, name);
+
+-- UserStats.fetch (most_sniped, avg_title_score)
+CREATE INDEX IF NOT EXISTS title_participant_id ON title (participant_id);
+
+-- UserStats.fetch (avg_rate, most_watched), export
+CREATE INDEX IF NOT EXISTS roll_participant_id ON roll (participant_id, score);
+CREATE INDEX IF NOT EXISTS roll_title_id ON roll (title_id);
+
+-- KarmaHistory.fetch_user_karma, KarmaHistory.fetch_karma_history
+CREATE INDEX IF NOT EXISTS karma_history_user_id_time ON karma_history (user_id, time, karma);
+
+-- Challenge.fetch_banned_users, State.is_user_banned
+CREATE INDEX IF NOT EXISTS banned_user_challenge_id ON banned_user (challenge_id, user_id);
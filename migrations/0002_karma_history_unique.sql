@@ -0,0 +1,7 @@
+-- One karma value per user and point in time, so rounds can be applied with a single upsert.
+DELETE FROM karma_history WHERE rowid NOT IN (
+	SELECT MAX(rowid) FROM karma_history GROUP BY user_id, time
+);
+
+DROP INDEX IF EXISTS karma_history_user_id_time;
+CREATE UNIQUE INDEX karma_history_user_id_time ON karma_history (user_id, time);
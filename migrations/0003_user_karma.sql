@@ -0,0 +1,45 @@
+-- Current karma of every user, i.e. the newest karma_history row.
+-- Kept in sync by triggers, so it changes in the same transaction as karma_history.
+CREATE TABLE user_karma (
+	user_id INTEGER NOT NULL PRIMARY KEY,
+	karma INTEGER NOT NULL,
+	"time" TIMESTAMP NOT NULL,
+
+	FOREIGN KEY (user_id) REFERENCES user (id)
+);
+
+INSERT INTO user_karma (user_id, karma, time)
+SELECT KH.user_id, KH.karma, KH.time FROM karma_history KH
+WHERE KH.time = (SELECT MAX(time) FROM karma_history WHERE user_id = KH.user_id);
+
+CREATE TRIGGER karma_history_insert AFTER INSERT ON karma_history
+BEGIN
+	INSERT OR REPLACE INTO user_karma (user_id, karma, time)
+	SELECT user_id, karma, time FROM karma_history
+	WHERE user_id = NEW.user_id
+	ORDER BY time DESC LIMIT 1;
+END;
+
+CREATE TRIGGER karma_history_update AFTER UPDATE ON karma_history
+BEGIN
+	DELETE FROM user_karma WHERE user_id IN (OLD.user_id, NEW.user_id);
+	INSERT INTO user_karma (user_id, karma, time)
+	SELECT user_id, karma, time FROM (
+		SELECT user_id, karma, time FROM karma_history
+		WHERE user_id = OLD.user_id
+		ORDER BY time DESC LIMIT 1)
+	UNION
+	SELECT user_id, karma, time FROM (
+		SELECT user_id, karma, time FROM karma_history
+		WHERE user_id = NEW.user_id
+		ORDER BY time DESC LIMIT 1);
+END;
+
+CREATE TRIGGER karma_history_delete AFTER DELETE ON karma_history
+BEGIN
+	DELETE FROM user_karma WHERE user_id = OLD.user_id;
+	INSERT INTO user_karma (user_id, karma, time)
+	SELECT user_id, karma, time FROM karma_history
+	WHERE user_id = OLD.user_id
+	ORDER BY time DESC LIMIT 1;
+END;
@@ -0,0 +1,17 @@
+-- Title metadata fetched from kinopoisk/myanimelist, keyed by the provider's own id.
+-- Rows with a NULL name are cached failures.
+CREATE TABLE title_info_cache (
+	provider TEXT NOT NULL,
+	provider_id TEXT NOT NULL,
+	name TEXT DEFAULT NULL,
+	score FLOAT DEFAULT NULL,
+	duration INTEGER DEFAULT NULL,
+	num_of_episodes INTEGER DEFAULT NULL,
+	difficulty INTEGER DEFAULT NULL,
+	fetched_time TIMESTAMP NOT NULL,
+	accessed_time TIMESTAMP NOT NULL,
+
+	PRIMARY KEY (provider, provider_id)
+);
+
+CREATE INDEX title_info_cache_accessed_time ON title_info_cache (accessed_time);
@@ -0,0 +1,7 @@
+-- Last title whose info was refilled by an interrupted !refill_title_info, per guild.
+CREATE TABLE refill_checkpoint (
+	guild_id INTEGER NOT NULL PRIMARY KEY,
+	title_id INTEGER NOT NULL,
+
+	FOREIGN KEY (guild_id) REFERENCES guild (id)
+);
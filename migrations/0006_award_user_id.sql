@@ -0,0 +1,18 @@
+-- Awards are given to users (!add_award), not to a challenge's participant. init.sql declared
+-- award.participant_id while the bot always reads and writes award.user_id, so a table created
+-- from it can't hold any rows. Rebuilds award keyed by user. The copy is by position, which is
+-- right for a user_id table and a no-op for the empty participant_id one.
+CREATE TABLE award_new (
+	user_id INTEGER NOT NULL,
+	"url" TEXT DEFAULT NULL,
+	"time" TIMESTAMP NOT NULL,
+
+	FOREIGN KEY (user_id) REFERENCES user (id)
+);
+
+INSERT INTO award_new SELECT * FROM award;
+DROP TABLE award;
+ALTER TABLE award_new RENAME TO award;
+
+-- User.remove_award, UserStats.fetch
+CREATE INDEX award_user_id ON award (user_id, url);
@@ -0,0 +1,52 @@
+import asyncio
+from db import Title
+
+BATCH_SIZE = 20
+MAX_ATTEMPTS = 5
+BACKOFF = 0.5 # seconds before the first retry, doubled after every failed attempt
+MAX_FAILURES_SHOWN = 15 # keeps the failure summary within a single discord message
+
+async def fetch_with_backoff(db, cache, url, pending=None):
+    for attempt in range(MAX_ATTEMPTS):
+        # Retries skip the cache, otherwise they would just hit the cached failure
+        info = await cache.fetch(db, url, refresh=attempt > 0, pending=pending)
+        if info is not None:
+            return info
+        if attempt + 1 < MAX_ATTEMPTS:
+            await asyncio.sleep(BACKOFF * 2 ** attempt)
+    return None
+
+async def refill_guild(db, guild, cache, report):
+    # Titles are refilled in id order, a batch at a time. Every batch is committed together
+    # with the checkpoint, so an interrupted refill resumes after the last committed batch.
+    # The fetches themselves are rate limited per provider by the http clients. Nothing is written
+    # while they run, so other commands keep reading from the reader pool: the title info cache
+    # entries and the titles of a batch are written together right before its commit.
+    # Titles without an url have nothing to refill from and are only counted.
+    checkpoint = await guild.fetch_refill_checkpoint()
+    titles = await guild.fetch_titles(after_id=checkpoint)
+    failed = []
+    skipped = 0
+    for start in range(0, len(titles), BATCH_SIZE):
+        batch = titles[start:start + BATCH_SIZE]
+        with_url = [title for title in batch if title.url]
+        skipped += len(batch) - len(with_url)
+        pending = {}
+        infos = await asyncio.gather(*[fetch_with_backoff(db, cache, title.url, pending) for title in with_url])
+
+        rows = []
+        for title, info in zip(with_url, infos):
+            if info is None:
+                failed.append(title)
+            else:
+                rows.append((info.score, info.duration, info.num_of_episodes, info.difficulty, title.id))
+
+        await cache.store_all(db, pending)
+        await Title.update_infos(db, rows)
+        await guild.set_refill_checkpoint(batch[-1].id)
+        await db.commit()
+        await report(start + len(batch), len(titles), failed)
+
+    await guild.set_refill_checkpoint(None)
+    await db.commit()
+    return failed, skipped
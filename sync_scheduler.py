@@ -0,0 +1,52 @@
+import asyncio
+import time
+
+class SyncScheduler:
+    # Coalesces sync requests per key. A dirty key is flushed after `quiet_period` seconds without
+    # new requests, but no later than `max_delay` seconds after it was first marked dirty.
+    def __init__(self, sync, on_error, quiet_period, max_delay):
+        self.sync = sync
+        self.on_error = on_error
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+        self.pending = {} # key -> (first_marked, ctx, task)
+        self.locks = {}
+
+    def mark_dirty(self, key, ctx):
+        now = time.monotonic()
+        first_marked = now
+        if key in self.pending:
+            first_marked, _, task = self.pending[key]
+            task.cancel()
+        delay = max(0, min(self.quiet_period, first_marked + self.max_delay - now))
+        task = asyncio.ensure_future(self._flush_later(key, delay))
+        self.pending[key] = (first_marked, ctx, task)
+
+    async def _flush_later(self, key, delay):
+        await asyncio.sleep(delay)
+        _, ctx, _ = self.pending.pop(key)
+        try:
+            await self._sync(key)
+        except Exception as e:
+            await self.on_error(ctx, e)
+
+    async def _sync(self, key):
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        async with self.locks[key]:
+            await self.sync(key)
+
+    async def flush(self, key):
+        if key in self.pending:
+            _, _, task = self.pending.pop(key)
+            task.cancel()
+        await self._sync(key)
+
+    async def flush_all(self):
+        for key in list(self.pending.keys()):
+            _, ctx, task = self.pending.pop(key)
+            task.cancel()
+            try:
+                await self._sync(key)
+            except Exception as e:
+                await self.on_error(ctx, e)
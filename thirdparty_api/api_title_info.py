@@ -1,4 +1,3 @@
-import requests
 import re
 
 import thirdparty_api.kinopoisk_api as kinopoisk_api
@@ -13,12 +12,22 @@ class ApiTitleInfo:
         self.num_of_episodes = num_of_episodes
 
     @staticmethod
-    def from_url(url, config):
+    def canonical_id(url):
+        m = re.search(r'kinopoisk\.ru/film/(\d+)', url)
+        if m:
+            return ('kinopoisk', m[1])
+        m = re.search(r'myanimelist\.net/anime/(\d+)', url)
+        if m:
+            return ('myanimelist', m[1])
+        return None
+
+    @staticmethod
+    async def from_url(url, config):
         score = None
         name = None
         try:
             if re.search(r'kinopoisk', url):
-                json = kinopoisk_api.get_film_data(url, config['kinopoisk_api_token'])
+                json = await kinopoisk_api.get_film_data(url, config['kinopoisk_api_token'])
                 name = json['data']['nameRu']
                 if not name:
                     name = json['data']['nameEn']
@@ -30,7 +39,7 @@ class ApiTitleInfo:
                 num_of_episodes = 1
                 return ApiTitleInfo(name, score, duration, num_of_episodes, difficulty) 
             elif re.search(r'myanimelist', url):
-                data = mal_api.get_anime_data(url)
+                data = await mal_api.get_anime_data(url)
                 name = data['name']
                 score = data['score']
                 num_of_episodes = data['num_of_episodes']
@@ -0,0 +1,58 @@
+import asyncio
+import aiohttp
+import time
+
+clients = []
+
+class TokenBucket:
+    # Allows `rate` requests per second on average with bursts of up to `capacity` requests
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class HttpClient:
+    # Keep-alive session for a single provider with strict timeouts, bounded concurrency and a rate limit.
+    # The session and the semaphore are created on first use, inside the running event loop.
+    def __init__(self, limit=4, rate=5, burst=5, connect_timeout=5, read_timeout=10, keepalive_timeout=60):
+        self.limit = limit
+        self.bucket = TokenBucket(rate, burst)
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        self.keepalive_timeout = keepalive_timeout
+        self.session = None
+        self.semaphore = None
+        clients.append(self)
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self.semaphore = asyncio.Semaphore(self.limit)
+        return self.session
+
+    async def get(self, url, **kwargs):
+        session = self.get_session()
+        async with self.semaphore:
+            await self.bucket.acquire()
+            async with session.get(url, **kwargs) as response:
+                return response.status, await response.text()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+async def close_all():
+    for client in clients:
+        await client.close()
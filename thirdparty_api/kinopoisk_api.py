@@ -1,7 +1,10 @@
-import requests as r
 import json
 import re
 
+from thirdparty_api.http_client import HttpClient
+
+client = HttpClient(rate=10, burst=10)
+
 def get_id_from_url(url):
     r = r'^.*?kinopoisk.ru/film/(\d+)'
     return re.search(r, url)[1]
@@ -17,14 +20,14 @@ def length_to_minutes(length):
     parts = length.split(":")
     return int(parts[0]) * 60 + int(parts[1]) # hope it works
 
-def get_film_data(url, token, tables=['RATING']):
+async def get_film_data(url, token, tables=['RATING']):
     id = get_id_from_url(url)
     headers = {'X-API-KEY': token, 'accept': 'application/json'}
     param=''
     if len(tables):
         param = f'?append_to_response={"&".join(tables)}'
-    response = r.get(f"https://kinopoiskapiunofficial.tech/api/v2.1/films/{id}{param}", headers=headers)
-    if response.status_code == 200:
-        return json.loads(response.text)
+    status, text = await client.get(f"https://kinopoiskapiunofficial.tech/api/v2.1/films/{id}{param}", headers=headers)
+    if status == 200:
+        return json.loads(text)
     else:
-        raise "Bad kinopoisk api status code recieved"
\ No newline at end of file
+        raise Exception("Bad kinopoisk api status code recieved")
\ No newline at end of file
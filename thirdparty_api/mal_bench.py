@@ -0,0 +1,66 @@
+# Checks mal_parser against the saved pages in mal_corpus and times it.
+# Run with: python -m thirdparty_api.mal_bench [number of runs per page]
+# The pages shipped so far are synthetic, modelled on MAL's markup. Real pages are added with
+#   python -m thirdparty_api.mal_bench save <myanimelist url> <file name>
+# which saves the page and prints what the parser makes of it; check that against the site
+# by hand before putting it into expected.json.
+import asyncio
+import json
+import os
+import sys
+import timeit
+
+from thirdparty_api import mal_parser
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'mal_corpus')
+
+def load_corpus():
+    with open(os.path.join(CORPUS_DIR, 'expected.json')) as f:
+        expected = json.load(f)
+    corpus = []
+    for fname in sorted(expected):
+        with open(os.path.join(CORPUS_DIR, fname), encoding='utf-8') as f:
+            corpus.append((fname, f.read(), expected[fname]))
+    return corpus
+
+def parse_or_none(html):
+    try:
+        return mal_parser.parse(html)
+    except ValueError:
+        return None
+
+async def save(url, fname):
+    from thirdparty_api.http_client import close_all
+    from thirdparty_api.mal_api import client
+    try:
+        status, html = await client.get(url)
+    finally:
+        await close_all()
+    if status != 200:
+        print(f'{url}: status {status}')
+        return 1
+    with open(os.path.join(CORPUS_DIR, fname), 'w', encoding='utf-8') as f:
+        f.write(html)
+    print(json.dumps({ fname: parse_or_none(html) }, indent=4, ensure_ascii=False))
+    return 0
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == 'save':
+        return asyncio.run(save(sys.argv[2], sys.argv[3]))
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    failed = 0
+    total = 0
+    for fname, html, expected in load_corpus():
+        result = parse_or_none(html)
+        seconds = timeit.timeit(lambda: parse_or_none(html), number=number) / number
+        total += seconds
+        status = 'ok' if result == expected else 'FAIL'
+        print(f'{status:4} {seconds * 1e6:9.1f} us  {len(html) // 1024:4} KiB  {fname}')
+        if result != expected:
+            failed += 1
+            print(f'     expected {expected}\n     got      {result}')
+    print(f'total {total * 1e6:.1f} us per corpus pass, {failed} failed')
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,47 @@
+import html
+import re
+
+DEFAULT_LENGTH = 20 # todo: decide if it's ok to do it like that? maybe should handle it differently
+DEFAULT_NUM_OF_EPISODES = 12 # airing shows list "Episodes: Unknown", count them as one season
+
+# Every field of the page in one alternation, so the page is scanned once, front to back.
+# Fields only match in the form they take on a MAL page, including "Episodes: Unknown" and an "N/A"
+# score, so those never pick up some unrelated number further down. The scan stops at the main column
+# (the "rightside" div), since every field lives either in <head> or in the info sidebar.
+FIELDS = re.compile(r'''
+      <meta\ property="og:title"\ content="(?P<name>[^"]*)">
+    | score-label[^>]*>(?P<score>\d+\.\d+|N/A)<
+    | pisodes:</span>\s*(?P<num_of_episodes>\d+|Unknown)
+    | uration:</span>\s*(?P<length>(?:(?P<hours>\d+)\ hr\.?\s*)?(?:(?P<minutes>\d+)\ min)?)
+    | (?P<end>class="rightside)
+''', re.VERBOSE)
+
+FIELD_NAMES = ('name', 'score', 'num_of_episodes', 'length')
+
+def parse(page):
+    found = {}
+    for m in FIELDS.finditer(page):
+        field = m.lastgroup
+        if field == 'end':
+            break
+        if field in found:
+            continue
+        if field == 'length':
+            found[field] = 60 * int(m['hours'] or 0) + int(m['minutes'] or 0)
+        else:
+            found[field] = m[field]
+        if len(found) == len(FIELD_NAMES):
+            break
+
+    # Only the name is required, unscored and airing titles still have one
+    if 'name' not in found:
+        raise ValueError('Failed to parse myanimelist page: name not found')
+
+    score = found.get('score', 'N/A')
+    num_of_episodes = found.get('num_of_episodes', 'Unknown')
+    return {
+        'name': html.unescape(found['name']),
+        'score': None if score == 'N/A' else float(score),
+        'num_of_episodes': DEFAULT_NUM_OF_EPISODES if num_of_episodes == 'Unknown' else int(num_of_episodes),
+        'length': found.get('length') or DEFAULT_LENGTH
+    }
@@ -0,0 +1,92 @@
+import asyncio
+
+from datetime import datetime, timedelta
+from thirdparty_api.api_title_info import ApiTitleInfo
+
+class TitleInfoCache:
+    # Caches ApiTitleInfo in the title_info_cache table, keyed by the provider's id of a title.
+    # Failures are cached for a shorter time. With stale_while_revalidate an expired entry is
+    # returned right away and refreshed in the background.
+    # The cache never commits: entries are written through the caller's db and committed with
+    # the caller's own writes. Access times of hits and background refreshes are kept in memory
+    # until the next entry is stored. Callers that fetch many titles at once pass a pending dict,
+    # which collects the new entries instead, and write it with store_all() when they are done.
+    def __init__(self, config):
+        self.config = config
+        self.ttl = timedelta(days=config.get('title_info_ttl_days', 30))
+        self.negative_ttl = timedelta(minutes=config.get('title_info_negative_ttl_minutes', 10))
+        self.max_size = config.get('title_info_cache_size', 10000)
+        self.stale_while_revalidate = config.get('title_info_stale_while_revalidate', True)
+        self.refreshing = set()
+        self.revalidated = {} # key -> info refreshed in the background, not stored yet
+        self.accessed = {}    # key -> time of the last hit, not stored yet
+
+    async def fetch(self, db, url, refresh=False, pending=None):
+        key = ApiTitleInfo.canonical_id(url)
+        if key is None:
+            return await ApiTitleInfo.from_url(url, self.config)
+        if refresh:
+            return await self.refresh(db, key, url, pending)
+        if key in self.revalidated:
+            info = self.revalidated.pop(key)
+            await self.store(db, key, info, pending)
+            return info
+
+        row = await db.fetchrow('''
+            SELECT name, score, duration, num_of_episodes, difficulty, fetched_time
+            FROM title_info_cache
+            WHERE provider = ? AND provider_id = ?''', key)
+        if row is not None:
+            info = None if row[0] is None else ApiTitleInfo(*row[:5])
+            age = datetime.now() - row[5]
+            is_fresh = age < (self.negative_ttl if info is None else self.ttl)
+            if is_fresh or info is not None and self.stale_while_revalidate:
+                if not is_fresh and key not in self.refreshing:
+                    self.refreshing.add(key)
+                    asyncio.ensure_future(self._revalidate(key, url))
+                self.accessed[key] = datetime.now()
+                return info
+
+        return await self.refresh(db, key, url, pending)
+
+    async def _revalidate(self, key, url):
+        # Runs outside of any command, so the result waits in memory for the next fetch to store it
+        try:
+            info = await ApiTitleInfo.from_url(url, self.config)
+            if info is not None: # otherwise keep serving the stale entry
+                self.revalidated[key] = info
+        finally:
+            self.refreshing.discard(key)
+
+    async def refresh(self, db, key, url, pending=None):
+        info = await ApiTitleInfo.from_url(url, self.config)
+        await self.store(db, key, info, pending)
+        return info
+
+    async def store(self, db, key, info, pending=None):
+        if pending is None:
+            await self.store_all(db, { key: info })
+        else:
+            pending[key] = info
+
+    async def store_all(self, db, infos):
+        now = datetime.now()
+        rows = []
+        for key, info in infos.items():
+            vals = [None] * 5 if info is None else [info.name, info.score, info.duration, info.num_of_episodes, info.difficulty]
+            self.accessed.pop(key, None)
+            rows.append(list(key) + vals + [now, now])
+        await db.executemany('''
+            INSERT OR REPLACE INTO title_info_cache
+            (provider, provider_id, name, score, duration, num_of_episodes, difficulty, fetched_time, accessed_time)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+        if self.accessed:
+            accessed, self.accessed = self.accessed, {}
+            await db.executemany('''
+                UPDATE title_info_cache SET accessed_time = ?
+                WHERE provider = ? AND provider_id = ?''', [[time] + list(k) for k, time in accessed.items()])
+        await db.execute('''
+            DELETE FROM title_info_cache WHERE rowid IN (
+                SELECT rowid FROM title_info_cache
+                ORDER BY accessed_time DESC
+                LIMIT -1 OFFSET ?)''', [self.max_size])
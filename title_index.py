@@ -0,0 +1,109 @@
+import heapq
+
+from collections import Counter
+from fuzzywuzzy import fuzz, utils
+
+MATCH_THRESHOLD = 60
+NUM_CANDIDATES = 16 # titles sharing the most trigrams with the query that get scored by fuzz.WRatio
+
+def normalize(name):
+    return utils.full_process(name)
+
+def trigrams(normalized):
+    padded = f'  {normalized} '
+    return { padded[i:i + 3] for i in range(len(padded) - 2) }
+
+class TitleMatch:
+    def __init__(self, title_id, name, score):
+        self.title_id = title_id
+        self.name = name
+        self.score = score
+
+class TitleIndex:
+    # Trigram index over the titles of one challenge. A search only scores the titles that share
+    # the most trigrams with the query, instead of running fuzz.WRatio against every title.
+    def __init__(self, rows):
+        self.names = {}      # title id -> name
+        self.normalized = {} # title id -> normalized name
+        self.grams = {}      # title id -> trigrams of the normalized name
+        self.postings = {}   # trigram -> ids of titles containing it
+        for title_id, name in rows:
+            self.add(title_id, name)
+
+    def add(self, title_id, name):
+        self.names[title_id] = name
+        self.normalized[title_id] = normalize(name)
+        self.grams[title_id] = trigrams(self.normalized[title_id])
+        for gram in self.grams[title_id]:
+            self.postings.setdefault(gram, set()).add(title_id)
+
+    def remove(self, title_id):
+        self.names.pop(title_id, None)
+        self.normalized.pop(title_id, None)
+        for gram in self.grams.pop(title_id, ()):
+            ids = self.postings[gram]
+            ids.discard(title_id)
+            if not ids:
+                del self.postings[gram]
+
+    def rename(self, title_id, name):
+        self.remove(title_id)
+        self.add(title_id, name)
+
+    def candidates(self, query):
+        # Ranked by the Dice coefficient of the trigram sets, so short names aren't crowded out
+        # by longer ones that merely contain them
+        query_grams = trigrams(query)
+        counts = Counter()
+        for gram in query_grams:
+            counts.update(self.postings.get(gram, ()))
+        dice = lambda title_id: 2 * counts[title_id] / (len(query_grams) + len(self.grams[title_id]))
+        return heapq.nlargest(NUM_CANDIDATES, counts, key=dice)
+
+    def search(self, query, limit=5):
+        # Best matches first, only those scoring at least MATCH_THRESHOLD.
+        # Equal top scores mean the query is ambiguous.
+        query = normalize(query)
+        if not query:
+            return []
+        matches = []
+        for title_id in self.candidates(query):
+            score = fuzz.WRatio(query, self.normalized[title_id], full_process=False)
+            if score >= MATCH_THRESHOLD:
+                matches.append(TitleMatch(title_id, self.names[title_id], score))
+        matches.sort(key=lambda m: (-m.score, m.title_id))
+        return matches[:limit]
+
+# Process-wide indexes, built on first search and kept up to date by the title/pool write paths
+indexes = {}      # challenge id -> TitleIndex
+challenge_of = {} # title id -> challenge id, for the titles of built indexes
+
+async def fetch_index(db, challenge_id):
+    if challenge_id not in indexes:
+        rows = await db.fetchall('''
+            SELECT T.id, T.name FROM title T
+            JOIN pool P ON P.id = T.pool_id
+            WHERE P.challenge_id = ?''', [challenge_id])
+        indexes[challenge_id] = TitleIndex(rows)
+        for title_id, _ in rows:
+            challenge_of[title_id] = challenge_id
+    return indexes[challenge_id]
+
+def on_add(challenge_id, title_id, name):
+    if challenge_id in indexes:
+        indexes[challenge_id].add(title_id, name)
+        challenge_of[title_id] = challenge_id
+
+def on_rename(title_id, name):
+    if title_id in challenge_of:
+        indexes[challenge_of[title_id]].rename(title_id, name)
+
+def on_remove(title_id):
+    if title_id in challenge_of:
+        indexes[challenge_of.pop(title_id)].remove(title_id)
+
+def invalidate(challenge_id):
+    index = indexes.pop(challenge_id, None)
+    if index is not None:
+        for title_id in index.names:
+            challenge_of.pop(title_id, None)